@@ -3,15 +3,40 @@ import time
 import uuid
 import threading
 import json
-
+import gzip
+import base64
+import bisect
+import sqlite3
+import re
+import difflib
+import random
+import email.utils
+import sys
+import collections
+import contextlib
+import heapq
+import itertools
+import math
+import atexit
+import signal
+import hashlib
+import hmac
+import secrets
+import datetime
+import unicodedata
+
+import httplib2
 import requests
-from flask import Flask, request, jsonify, send_from_directory, Response, send_file
+from flask import Flask, Request, request, jsonify, send_from_directory, Response, send_file, g, has_request_context
 from urllib.parse import urlparse
 
 # Google Drive imports
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.oauth2.credentials import Credentials
+import google.auth.transport.requests
+import google_auth_httplib2
 from googleapiclient.discovery import build
+import googleapiclient.errors
 import googleapiclient.http
 
 # Slack imports
@@ -19,6 +44,9 @@ from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 from dotenv import load_dotenv
 
+# Metrics imports
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
 # Selenium imports
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
@@ -42,7 +70,10 @@ client = WebClient(token=SLACK_BOT_TOKEN)
 
 # File paths and scopes
 CLIENT_SECRET_FILE = 'client_secret.json'  # Path to your client_secret.json file
-TOKEN_FILE = 'token.json'
+TOKEN_FILE = 'token.json'  # Token of a single-user deployment, used for the default user
+TOKEN_DIR = 'tokens'  # One OAuth token file per user
+DRIVE_MIRROR_DIR = 'drive_mirrors'  # One local mirror of Drive file metadata per user
+SEARCH_INDEX_FILE = 'search_index.db'  # Full-text index of Google Docs content
 SCOPES = [
     'https://www.googleapis.com/auth/drive',
     'https://www.googleapis.com/auth/documents',
@@ -64,14 +95,948 @@ os.makedirs(OUTPUT_FOLDER, exist_ok=True)  # Ensure folder exists
 OUTPUT_DIR = "scraped_pages"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# Scrape output modes: one Drive file per page, or pages streamed into gzip'd WARC shards
+OUTPUT_MODE_PAGES = "pages"
+OUTPUT_MODE_BUNDLE = "bundle"
+DEFAULT_SHARD_SIZE_MB = 50
+RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024  # Must be a multiple of 256 KB
+
 # Global variables for scraping
 tasks = {}
 driver = None
 selenium_initialized = False
 selenium_error_message = None
 
-# Google Drive Service
-drive_service = None
+# Multi-tenant credentials
+DEFAULT_USER_ID = 'default'  # Callers that send no X-User-Id header
+CALLER_ID_SECRET = os.getenv("CALLER_ID_SECRET")  # When set, X-User-Id must be "<user id>.<hex HMAC-SHA256>"
+MAX_CACHED_USERS = 1000  # Users whose credentials and built services are kept in memory
+MAX_CACHED_BUNDLE_INDEXES = 8  # Bundle indexes kept in memory per user, least recently used dropped first
+TOKEN_REFRESH_INTERVAL = 60  # Seconds between background token refresh passes
+TOKEN_REFRESH_MARGIN = 300  # Refresh tokens expiring within this many seconds
+AUTH_STATE_TTL = 600  # Seconds a /startAuth sign-in may take to complete
+pending_auth_states = {}  # OAuth state -> (user ID, started at)
+pending_auth_states_lock = threading.Lock()
+
+# Drive metadata mirror, seeded by a full listing and kept current with the Changes API
+DRIVE_FILE_FIELDS = "id, name, mimeType, modifiedTime, parents, trashed"
+DRIVE_MIRROR_SYNC_INTERVAL = 30  # Seconds between Changes API polls
+DRIVE_MIRROR_RETRY_AFTER = 5  # Seconds a caller should wait while a user's mirror is first built
+LIST_FILES_SORT_FIELDS = ('name', 'modifiedTime')
+GOOGLE_DOC_MIME_TYPE = 'application/vnd.google-apps.document'
+
+# Changed blocks (old + new characters) up to MAX_CHAR_DIFF_SIZE are diffed per character, up to
+# MAX_WORD_DIFF_SIZE per word, and larger ones are replaced whole; SequenceMatcher is quadratic
+MAX_CHAR_DIFF_SIZE = 2000
+MAX_WORD_DIFF_SIZE = 20000
+
+# Full-text search indexer
+SEARCH_INDEX_INTERVAL = 300  # Seconds between indexing passes
+search_index_lock = threading.Lock()
+
+# Upstream rate limits as (requests per second, burst size), kept under each provider's per-user quotas
+UPSTREAM_LIMITS = {
+    'drive': (20, 40),                          # 12,000 queries per minute per user
+    'docs': (5, 10),                            # 300 read requests per minute per user
+    'people': (1.5, 5),                         # 90 requests per minute per user
+    'slack.conversations_list': (20 / 60, 3),   # Tier 2: 20+ per minute
+    'slack.files_upload': (20 / 60, 3),         # Tier 2: 20+ per minute
+    'slack.chat_postMessage': (1, 3),           # About one message per second per channel
+    'elevenlabs': (2, 4),
+}
+PER_USER_UPSTREAMS = ('drive', 'docs', 'people')  # Google's quotas are per user, so each user gets their own buckets
+UPSTREAM_MAX_RETRIES = 4
+UPSTREAM_BACKOFF_BASE = 0.5  # Seconds
+UPSTREAM_BACKOFF_MAX = 20  # Seconds
+UPSTREAM_RETRY_AFTER_MAX = 60  # Longest Retry-After we are willing to wait, in seconds
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+CIRCUIT_FAILURE_THRESHOLD = 5  # Consecutive failed calls, each after all its retries, before an upstream's circuit opens
+CIRCUIT_RESET_TIMEOUT = 30  # Seconds before an open circuit lets a trial call through
+
+# Background job scheduler: worker pool size per job kind
+JOB_POOLS = {
+    'scrape': 1,  # Scrapes share one Selenium browser, so they run one at a time
+    'default': 2,  # Drive mirror syncs, search indexing passes and token refreshes
+}
+DEFAULT_JOB_PRIORITY = 5  # Lower numbers run first
+MAX_JOB_PRIORITY = 9  # Callers can only make their own jobs less urgent, between the default and this
+TOKEN_REFRESH_PRIORITY = 0  # Ahead of everything else, so requests never wait on a refresh
+SEARCH_INDEX_PRIORITY = MAX_JOB_PRIORITY
+SHUTDOWN_DRAIN_TIMEOUT = 300  # Seconds to let queued and running jobs finish on shutdown
+
+# Metrics and profiling
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+PROFILE_DIR = "profiles"  # Folded stacks of slow requests, for flamegraph.pl or speedscope
+PROFILER_SAMPLE_INTERVAL = 0.01  # Seconds between stack samples
+PROFILER_MIN_THRESHOLD_MS = 100  # Lower thresholds would write a profile for nearly every request
+PROFILER_ADMIN_TOKEN = os.getenv("PROFILER_ADMIN_TOKEN")  # Required in X-Admin-Token by /debug routes; unset disables them
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_COUNT = Counter('http_requests_total', 'HTTP requests handled', ['route', 'method', 'status'])
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency', ['route', 'method'],
+                            buckets=LATENCY_BUCKETS)
+UPSTREAM_LATENCY = Histogram('upstream_request_duration_seconds', 'Latency of each upstream call attempt',
+                             ['upstream'], buckets=LATENCY_BUCKETS)
+UPSTREAM_ERRORS = Counter('upstream_errors_total', 'Failed upstream call attempts', ['upstream', 'reason'])
+COALESCED_REQUESTS = Counter('upstream_coalesced_total', 'Reads that shared an in-flight upstream call', ['kind'])
+CACHE_REQUESTS = Counter('cache_requests_total', 'Cache lookups', ['cache', 'result'])
+SCRAPE_PAGES = Counter('scrape_pages_total', 'Pages scraped, use rate() for pages per second')
+SCRAPE_TASKS = Gauge('scrape_tasks', 'Scraping tasks by status', ['status'])
+SCRAPE_PENDING_URLS = Gauge('scrape_pending_urls', 'URLs waiting to be visited by running scrapes')
+
+for task_status_name in ('queued', 'processing', 'completed', 'error', 'cancelled'):
+    SCRAPE_TASKS.labels(status=task_status_name).set_function(
+        lambda status=task_status_name: sum(1 for task in list(tasks.values()) if task["status"] == status))
+SCRAPE_PENDING_URLS.set_function(
+    lambda: sum(task.get("pending_urls", 0) for task in list(tasks.values()) if task["status"] == "processing"))
+
+JOB_QUEUE_WAIT = Histogram('job_queue_wait_seconds', 'Time jobs spent queued before starting', ['kind'],
+                           buckets=LATENCY_BUCKETS)
+JOB_RUN_TIME = Histogram('job_run_seconds', 'Time jobs spent running', ['kind'],
+                         buckets=LATENCY_BUCKETS + (300, 900, 3600))
+JOB_QUEUE_DEPTH = Gauge('job_queue_depth', 'Jobs waiting for a worker', ['kind'])
+
+request_metric_children = {}  # (route, method, status) -> labelled request counter and histogram
+profiler = {"enabled": False, "threshold_ms": 1000, "sampler": None}  # sampler: the running sampling thread
+profiler_lock = threading.Lock()  # Guards starting and stopping the sampler
+profiled_requests = {}  # Thread ID -> Counter of folded stacks sampled while that thread handles a request
+
+
+class UpstreamError(Exception):
+    """
+    An upstream cannot serve calls right now. Routes let these propagate to the error handlers
+    below, which answer with 503 or 429 instead of a generic 500.
+    """
+
+
+class UpstreamUnavailableError(UpstreamError):
+    """Raised instead of calling an upstream whose circuit breaker is open. retry_after is in seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamThrottledError(UpstreamError):
+    """Raised when an upstream still answers 429 after all retries. retry_after is its Retry-After header."""
+
+    def __init__(self, name, retry_after=None):
+        super().__init__(f"{name} is rate limiting requests. Please try again later.")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Thread-safe token bucket. acquire() blocks until a token is available."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Opens after too many consecutive upstream failures and fails fast while open.
+    After the reset timeout a single trial call is let through; its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """Raise UpstreamUnavailableError while the circuit is open. Returns True for the trial call."""
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            if self.trial_in_flight or remaining > 0:
+                # Callers may retry once the reset timeout is over, or shortly while a trial call decides
+                raise UpstreamUnavailableError(f"{self.name} is unavailable, failing fast until it recovers.",
+                                               max(math.ceil(remaining), 1))
+            self.trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                print(f"Circuit for {self.name} closed.")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"Circuit for {self.name} opened after {self.failures} consecutive failures.")
+                self.opened_at = time.monotonic()
+
+
+# Shared buckets; Google calls only use them when they are not made for any particular user
+rate_limiters = {name: TokenBucket(rate, burst) for name, (rate, burst) in UPSTREAM_LIMITS.items()}
+# One circuit per provider, shared by all of its rate-limited methods
+circuit_breakers = {provider: CircuitBreaker(provider, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+                    for provider in {name.split('.')[0] for name in UPSTREAM_LIMITS}}
+
+# Errors raised when an upstream could not be reached at all
+CONNECTION_ERRORS = (OSError, httplib2.HttpLib2Error)
+
+
+def get_retry_after(headers):
+    """Case-insensitive lookup of the Retry-After header."""
+    for key, value in (headers or {}).items():
+        if key.lower() == 'retry-after':
+            return value
+    return None
+
+
+def upstream_status(result=None, error=None):
+    """Return (HTTP status, Retry-After) for an upstream result or error, or (None, None) if there is none."""
+    if isinstance(error, googleapiclient.errors.HttpError):
+        return error.resp.status, get_retry_after(error.resp)
+    if isinstance(error, SlackApiError):
+        return error.response.status_code, get_retry_after(error.response.headers)
+    if isinstance(result, requests.Response):
+        return result.status_code, get_retry_after(result.headers)
+    return None, None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Seconds to wait before the next attempt: Retry-After when the upstream sent one, else full-jitter backoff."""
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0), UPSTREAM_RETRY_AFTER_MAX)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after).timestamp()
+                return min(max(retry_at - time.time(), 0), UPSTREAM_RETRY_AFTER_MAX)
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+
+
+# The user that background work running in this thread acts for
+job_context = threading.local()
+
+
+@contextlib.contextmanager
+def acting_for(user_id):
+    """Attribute the upstream calls this thread makes to user_id, for work outside of a request."""
+    job_context.user_id = user_id
+    try:
+        yield
+    finally:
+        job_context.user_id = None
+
+
+def current_user_id():
+    """The user upstream calls are made for: the caller of the current request, or the user a job acts for."""
+    if has_request_context():
+        return get_caller_id()
+    return getattr(job_context, 'user_id', None)
+
+
+def get_rate_limiter(name):
+    """The token bucket for an upstream: the current user's for Google APIs, else the shared one."""
+    if name in PER_USER_UPSTREAMS:
+        session = user_sessions.cached(current_user_id())
+        if session is not None:
+            return session["rate_limiters"][name]
+    return rate_limiters[name]
+
+
+def call_upstream(name, func, *args, idempotent=True, **kwargs):
+    """
+    Call an upstream API through its rate limiter and circuit breaker, retrying on 429, 5xx
+    and connection errors with backoff. name is a key of UPSTREAM_LIMITS.
+    Non-idempotent calls are only retried on 429, where the upstream did not act on the request.
+    """
+    breaker = circuit_breakers[name.split('.')[0]]
+    limiter = get_rate_limiter(name)
+    attempt = 0
+    while True:
+        try:
+            trial = breaker.before_call()
+        except UpstreamUnavailableError:
+            UPSTREAM_ERRORS.labels(upstream=name, reason='circuit_open').inc()
+            raise
+        limiter.acquire()
+        result = error = None
+        started = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            error = e
+        UPSTREAM_LATENCY.labels(upstream=name).observe(time.perf_counter() - started)
+        status, retry_after = upstream_status(result, error)
+        if error is not None or (status or 0) >= 400:
+            UPSTREAM_ERRORS.labels(upstream=name, reason=str(status or type(error).__name__)).inc()
+
+        connection_failed = error is not None and status is None and isinstance(error, CONNECTION_ERRORS)
+        if status not in RETRYABLE_STATUS_CODES and not connection_failed:
+            breaker.record_success()
+            if error is not None:
+                raise error
+            return result
+
+        # A 429 means the upstream is up but throttling us, so it never counts as a failure
+        if status == 429:
+            breaker.record_success()
+            trial = False
+
+        # The circuit counts failed calls, not attempts, so one request retrying cannot open it
+        # alone; a failed trial call is not retried and re-opens the circuit straight away
+        if trial or attempt >= UPSTREAM_MAX_RETRIES or not (idempotent or status == 429):
+            if status == 429:
+                raise UpstreamThrottledError(name, retry_after) from error
+            breaker.record_failure()
+            if error is not None:
+                raise error
+            return result
+
+        delay = backoff_delay(attempt, retry_after)
+        print(f"{name} call failed ({status or error}), retrying in {delay:.1f}s.")
+        time.sleep(delay)
+        attempt += 1
+
+
+@contextlib.contextmanager
+def track_upstream(name):
+    """Record latency and errors of an upstream call that does not go through call_upstream."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        UPSTREAM_ERRORS.labels(upstream=name, reason=type(e).__name__).inc()
+        raise
+    finally:
+        UPSTREAM_LATENCY.labels(upstream=name).observe(time.perf_counter() - started)
+
+
+class SingleFlight:
+    """
+    Lets concurrent identical read calls share one in-flight upstream call.
+    The first caller for a key makes the call; callers arriving while it is in flight wait for it
+    and receive the same result, or the same exception. Only use this for reads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self.calls[key] = call
+            else:
+                COALESCED_REQUESTS.labels(kind=key[0]).inc()
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = func(*args, **kwargs)
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["done"].set()
+
+
+# Shared by the read endpoints: /readDoc, /getContacts and /list_channels
+upstream_reads = SingleFlight()
+
+
+class JobScheduler:
+    """
+    Owns all background work. Each job kind runs on its own bounded pool of worker threads,
+    fed by a priority queue. Within a priority, jobs from different users are interleaved
+    round-robin, so one user's burst cannot starve everyone else.
+
+    Cancellation is cooperative: a queued job is dropped, a running job must poll is_cancelled().
+    Recurring work is registered with every(), whose callbacks run on one timer thread and
+    submit jobs rather than doing the work themselves.
+    """
+
+    def __init__(self, pools):
+        self.pools = pools
+        self.condition = threading.Condition()
+        self.queues = {kind: [] for kind in pools}
+        self.user_rounds = {kind: {} for kind in pools}  # Next fairness round per user
+        self.current_rounds = {kind: 0 for kind in pools}  # Round of the last job started
+        self.running = {kind: 0 for kind in pools}
+        self.jobs = {}
+        self.sequence = itertools.count()
+        self.accepting = True
+        self.stopped = False
+        self.started_kinds = set()
+        self.periodic = []  # [next run, interval, callback]
+        self.timer = None
+
+        for kind in pools:
+            JOB_QUEUE_DEPTH.labels(kind=kind).set_function(lambda kind=kind: self.queued_count(kind))
+
+    def _start_workers(self, kind):
+        for number in range(self.pools[kind]):
+            threading.Thread(target=self._work, args=(kind,), name=f"{kind}-worker-{number}",
+                             daemon=True).start()
+        self.started_kinds.add(kind)
+
+    def submit(self, kind, task_id, user_id, func, *args, priority=DEFAULT_JOB_PRIORITY):
+        """Queue func(*args) to run on the kind's worker pool."""
+        with self.condition:
+            if not self.accepting:
+                raise RuntimeError("The server is shutting down and is not accepting new jobs.")
+            if kind not in self.started_kinds:
+                self._start_workers(kind)
+
+            fairness_round = max(self.user_rounds[kind].get(user_id, 0), self.current_rounds[kind])
+            self.user_rounds[kind][user_id] = fairness_round + 1
+            job = {
+                "task_id": task_id, "kind": kind, "user_id": user_id, "func": func, "args": args,
+                "round": fairness_round, "cancelled": threading.Event(),
+                "queued_at": time.time(), "started_at": None, "finished_at": None,
+            }
+            self.jobs[task_id] = job
+            heapq.heappush(self.queues[kind], (priority, fairness_round, next(self.sequence), job))
+            self.condition.notify_all()
+
+    def _work(self, kind):
+        while True:
+            with self.condition:
+                while not self.queues[kind] and not self.stopped:
+                    self.condition.wait()
+                if not self.queues[kind]:
+                    return
+                _, fairness_round, _, job = heapq.heappop(self.queues[kind])
+                if job["cancelled"].is_set():
+                    continue
+                self.current_rounds[kind] = max(self.current_rounds[kind], fairness_round)
+                self.running[kind] += 1
+                job["started_at"] = time.time()
+
+            JOB_QUEUE_WAIT.labels(kind=kind).observe(job["started_at"] - job["queued_at"])
+            try:
+                with acting_for(job["user_id"]):
+                    job["func"](*job["args"])
+            except Exception as e:
+                print(f"Job {job['task_id']} failed: {e}")
+            finally:
+                with self.condition:
+                    job["finished_at"] = time.time()
+                    self.running[kind] -= 1
+                    self.condition.notify_all()
+                JOB_RUN_TIME.labels(kind=kind).observe(job["finished_at"] - job["started_at"])
+
+    def every(self, interval, callback):
+        """Call callback() now and then every interval seconds until shutdown, on the timer thread."""
+        with self.condition:
+            self.periodic.append([time.time(), interval, callback])
+            if self.timer is None:
+                self.timer = threading.Thread(target=self._run_timer, name="scheduler-timer", daemon=True)
+                self.timer.start()
+            self.condition.notify_all()
+
+    def _run_timer(self):
+        while True:
+            with self.condition:
+                while self.accepting:
+                    entry = min(self.periodic, key=lambda entry: entry[0])
+                    remaining = entry[0] - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                if not self.accepting:
+                    return
+                entry[0] += entry[1]
+            try:
+                entry[2]()
+            except Exception as e:
+                print(f"Scheduling periodic jobs failed: {e}")
+
+    def is_pending(self, task_id):
+        """Whether a job is queued or running."""
+        with self.condition:
+            job = self.jobs.get(task_id)
+            return bool(job and not job["finished_at"])
+
+    def queued_count(self, kind=None):
+        kinds = [kind] if kind else list(self.queues)
+        with self.condition:
+            return sum(1 for k in kinds for entry in self.queues[k] if not entry[-1]["cancelled"].is_set())
+
+    def cancel(self, task_id):
+        """
+        Cancel a job. Returns "queued" if it had not started, "running" if it was asked to stop,
+        or None if there is no such job or it already finished.
+        """
+        with self.condition:
+            job = self.jobs.get(task_id)
+            if not job or job["finished_at"] or job["cancelled"].is_set():
+                return None
+            job["cancelled"].set()
+            if job["started_at"] is None:
+                job["finished_at"] = time.time()
+                return "queued"
+            return "running"
+
+    def is_cancelled(self, task_id):
+        job = self.jobs.get(task_id)
+        return bool(job and job["cancelled"].is_set())
+
+    def timing(self, task_id):
+        """Queue wait and run time of a job in seconds, so far."""
+        job = self.jobs.get(task_id)
+        if not job:
+            return None
+        now = time.time()
+        started = job["started_at"]
+        return {
+            "queue_wait_seconds": round((started or job["finished_at"] or now) - job["queued_at"], 3),
+            "run_seconds": round((job["finished_at"] or now) - started, 3) if started else None,
+        }
+
+    def shutdown(self, timeout=SHUTDOWN_DRAIN_TIMEOUT):
+        """
+        Stop accepting jobs and let queued and running jobs finish for up to timeout seconds,
+        then cancel whatever is left.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            self.accepting = False
+            while (any(self.running.values()) or any(
+                    not entry[-1]["cancelled"].is_set() for queue in self.queues.values() for entry in queue)):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            for job in self.jobs.values():
+                if not job["finished_at"]:
+                    job["cancelled"].set()
+            self.stopped = True
+            self.condition.notify_all()
+        print("Job scheduler drained.")
+
+
+scheduler = JobScheduler(JOB_POOLS)
+atexit.register(scheduler.shutdown)
+
+
+def user_key(user_id):
+    """File-safe key for a user ID, so user IDs never end up in paths."""
+    return hashlib.sha256(user_id.encode('utf-8')).hexdigest()
+
+
+def write_file_atomic(path, data):
+    """Write a file readable only by us, so readers see either the old or the new content."""
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as temp_file:
+        temp_file.write(data)
+    os.replace(temp_path, path)
+
+
+def token_path(user_id):
+    return os.path.join(TOKEN_DIR, f"{user_key(user_id)}.json")
+
+
+def load_user_credentials(user_id):
+    """Load a user's stored OAuth token, or None if the user never authenticated."""
+    path = token_path(user_id)
+    if not os.path.exists(path) and user_id == DEFAULT_USER_ID:
+        path = TOKEN_FILE
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as token_file:
+        return Credentials.from_authorized_user_info(json.load(token_file))
+
+
+def save_user_credentials(user_id, creds):
+    os.makedirs(TOKEN_DIR, exist_ok=True)
+    write_file_atomic(token_path(user_id), creds.to_json())
+
+
+def build_service(api, version, creds):
+    """
+    Build a Google API client that can be shared between threads.
+    httplib2 connections are not thread-safe, so every request gets its own authorized Http.
+    """
+    def build_request(http, *args, **kwargs):
+        authorized_http = google_auth_httplib2.AuthorizedHttp(creds, http=googleapiclient.http.build_http())
+        return googleapiclient.http.HttpRequest(authorized_http, *args, **kwargs)
+
+    # build_http() keeps 308 from being followed as a redirect, as resumable uploads need
+    authorized_http = google_auth_httplib2.AuthorizedHttp(creds, http=googleapiclient.http.build_http())
+    return build(api, version, http=authorized_http, requestBuilder=build_request)
+
+
+class UserSessions:
+    """
+    Bounded LRU of per-user sessions: credentials, built API clients, Google API rate limits,
+    the Drive mirror and fetched bundle indexes. An evicted user is loaded back from their token
+    file on the next request.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.sessions = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _add(self, user_id, creds):
+        previous = self.sessions.get(user_id)
+        session = {
+            "user_id": user_id,
+            "creds": creds,
+            "services": {},
+            # Signing in again must not refill the user's buckets
+            "rate_limiters": previous["rate_limiters"] if previous else
+            {name: TokenBucket(*UPSTREAM_LIMITS[name]) for name in PER_USER_UPSTREAMS},
+            "lock": threading.Lock(),
+            # snapshot holds the sorted indexes /listFiles serves from, replaced after every sync
+            "drive_mirror": {"files": {}, "page_token": None, "synced_at": 0, "snapshot": None},
+            "drive_mirror_lock": threading.Lock(),
+            "bundle_indexes": collections.OrderedDict(),
+        }
+        self.sessions[user_id] = session
+        self.sessions.move_to_end(user_id)
+        while len(self.sessions) > self.capacity:
+            self.sessions.popitem(last=False)
+        return session
+
+    def get(self, user_id):
+        """Return the user's session, or None if the user has not authenticated."""
+        if user_id is None:
+            return None
+        with self.lock:
+            session = self.sessions.get(user_id)
+            if session is not None:
+                self.sessions.move_to_end(user_id)
+                CACHE_REQUESTS.labels(cache='user_session', result='hit').inc()
+                return session
+        CACHE_REQUESTS.labels(cache='user_session', result='miss').inc()
+
+        creds = load_user_credentials(user_id)
+        if creds is None:
+            return None
+        with self.lock:
+            # Another request may have loaded the same user meanwhile
+            return self.sessions.get(user_id) or self._add(user_id, creds)
+
+    def cached(self, user_id):
+        """Return the user's session if it is in memory, without loading it or counting a lookup."""
+        with self.lock:
+            return self.sessions.get(user_id)
+
+    def set_credentials(self, user_id, creds):
+        """Store freshly granted credentials, replacing the user's session."""
+        save_user_credentials(user_id, creds)
+        with self.lock:
+            return self._add(user_id, creds)
+
+    def get_service(self, user_id, api, version, collection=None):
+        """
+        Return the user's API client, or None if the user has not authenticated.
+        With collection, return that collection of the client instead, e.g. 'documents' for Docs:
+        googleapiclient rebuilds a collection on every call, which costs tens of milliseconds and
+        megabytes for Docs, so it is built once per session like the client.
+        """
+        session = self.get(user_id)
+        if session is None:
+            return None
+        with session["lock"]:
+            service = session["services"].get((api, version))
+            if service is None:
+                service = build_service(api, version, session["creds"])
+                session["services"][(api, version)] = service
+            if collection is None:
+                return service
+            resource = session["services"].get((api, version, collection))
+            if resource is None:
+                resource = getattr(service, collection)()
+                session["services"][(api, version, collection)] = resource
+        return resource
+
+    def list(self):
+        with self.lock:
+            return list(self.sessions.values())
+
+
+user_sessions = UserSessions(MAX_CACHED_USERS)
+
+
+def refresh_user_token(session):
+    """Refresh a cached token and save it."""
+    creds = session["creds"]
+    try:
+        with session["lock"]:
+            creds.refresh(google.auth.transport.requests.Request())
+        save_user_credentials(session["user_id"], creds)
+    except Exception as e:
+        print(f"Error refreshing token for user {user_key(session['user_id'])[:12]}: {e}")
+
+
+def schedule_token_refreshes():
+    """Queue a refresh for every cached token that expires soon, so requests never wait on a refresh."""
+    for session in user_sessions.list():
+        creds = session["creds"]
+        if not creds.refresh_token or not creds.expiry:
+            continue
+        expires_in = creds.expiry - datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        if expires_in > datetime.timedelta(seconds=TOKEN_REFRESH_MARGIN):
+            continue
+        task_id = f"refresh-token-{user_key(session['user_id'])}"
+        if not scheduler.is_pending(task_id):
+            scheduler.submit('default', task_id, session["user_id"], refresh_user_token, session,
+                             priority=TOKEN_REFRESH_PRIORITY)
+
+
+def start_token_refresher():
+    """Have the scheduler refresh tokens in the background."""
+    scheduler.every(TOKEN_REFRESH_INTERVAL, schedule_token_refreshes)
+
+
+@app.before_request
+def authenticate_caller():
+    """
+    Identify the caller from the X-User-Id header. With CALLER_ID_SECRET set the header must be
+    signed, and callers without one are anonymous and cannot use any Google credentials.
+    Without the secret the server is single-user, so nobody can act as another user by
+    naming them in the header.
+    """
+    header = request.headers.get('X-User-Id')
+    if not header:
+        g.caller_id = None if CALLER_ID_SECRET else DEFAULT_USER_ID
+        return None
+    if not CALLER_ID_SECRET:
+        if header != DEFAULT_USER_ID:
+            return jsonify({'error': 'Multiple users require CALLER_ID_SECRET to be set on the server'}), 401
+        g.caller_id = DEFAULT_USER_ID
+        return None
+
+    user_id, _, signature = header.rpartition('.')
+    expected = hmac.new(CALLER_ID_SECRET.encode('utf-8'), user_id.encode('utf-8'), hashlib.sha256).hexdigest()
+    if not user_id or not hmac.compare_digest(signature, expected):
+        return jsonify({'error': 'Invalid X-User-Id signature'}), 401
+    g.caller_id = user_id
+    return None
+
+
+def get_caller_id():
+    """The authenticated caller, used to pick credentials and for per-user fairness."""
+    return g.get('caller_id')
+
+
+@app.errorhandler(UpstreamUnavailableError)
+def handle_upstream_unavailable(error):
+    """An upstream's circuit is open: tell the caller to come back once it may have recovered."""
+    response = jsonify({'error': str(error)})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 503
+
+
+@app.errorhandler(UpstreamThrottledError)
+def handle_upstream_throttled(error):
+    """Pass an upstream's 429 on to the caller, with its Retry-After."""
+    response = jsonify({'error': str(error)})
+    if error.retry_after:
+        response.headers['Retry-After'] = error.retry_after
+    return response, 429
+
+
+def fold_stack(frame):
+    """Fold a thread's stack into the one-line format used by flamegraph tools."""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def run_profiler():
+    """Sample the stacks of threads handling requests until the profiler is switched off."""
+    while True:
+        with profiler_lock:
+            if not profiler["enabled"]:
+                # Decided under the lock, so switching the profiler back on starts a new sampler
+                # instead of relying on this one, which is about to exit
+                profiler["sampler"] = None
+                profiled_requests.clear()
+                return
+        frames = sys._current_frames()
+        for thread_id, samples in list(profiled_requests.items()):
+            frame = frames.get(thread_id)
+            if frame is not None:
+                samples[fold_stack(frame)] += 1
+        time.sleep(PROFILER_SAMPLE_INTERVAL)
+
+
+def save_profile(route, elapsed, samples):
+    """Write the folded stacks of a slow request to PROFILE_DIR."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    route_name = route.strip("/").replace("/", "_").replace("<", "").replace(">", "") or "root"
+    file_path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{route_name}-{int(elapsed * 1000)}ms.folded")
+    with open(file_path, "w") as profile_file:
+        for stack, count in samples.items():
+            profile_file.write(f"{stack} {count}\n")
+    print(f"Saved profile of slow request to {route} ({elapsed:.2f}s): {file_path}")
+
+
+class MetricsRequest(Request):
+    """Flask request that leaves itself in the environ, where RequestMetricsMiddleware reads its route."""
+
+    ENVIRON_KEY = 'app.metrics_request'
+
+    def __init__(self, environ, *args, **kwargs):
+        super().__init__(environ, *args, **kwargs)
+        environ[self.ENVIRON_KEY] = self
+
+
+class RequestMetricsMiddleware:
+    """
+    WSGI middleware that records per-route request counts and latency, and hands the profiler's
+    samples of slow requests to save_profile. It runs outside Flask, because Flask's
+    context-local proxies and request hooks cost more per request than recording the metrics.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if not METRICS_ENABLED:
+            return self.wsgi_app(environ, start_response)
+
+        started = time.perf_counter()
+        thread_id = threading.get_ident()
+        if profiler["enabled"]:
+            profiled_requests[thread_id] = collections.Counter()
+
+        status_lines = []
+
+        def record_status(status, headers, exc_info=None):
+            status_lines.append(status)
+            return start_response(status, headers, exc_info)
+
+        result = self.wsgi_app(environ, record_status)
+        elapsed = time.perf_counter() - started
+
+        flask_request = environ.pop(MetricsRequest.ENVIRON_KEY, None)
+        url_rule = flask_request.url_rule if flask_request is not None else None
+        route = url_rule.rule if url_rule is not None else 'unmatched'
+        method = environ.get('REQUEST_METHOD', '')
+        status = status_lines[-1][:3] if status_lines else '500'
+
+        # labels() is the most expensive part of recording a metric, so the labelled children are reused
+        key = (route, method, status)
+        children = request_metric_children.get(key)
+        if children is None:
+            children = (REQUEST_COUNT.labels(route=route, method=method, status=status),
+                        REQUEST_LATENCY.labels(route=route, method=method))
+            request_metric_children[key] = children
+        children[0].inc()
+        children[1].observe(elapsed)
+
+        samples = profiled_requests.pop(thread_id, None)
+        if samples and elapsed * 1000 >= profiler["threshold_ms"]:
+            save_profile(route, elapsed, samples)
+        return result
+
+
+app.request_class = MetricsRequest
+app.wsgi_app = RequestMetricsMiddleware(app.wsgi_app)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus metrics: per-route request counts and latency, upstream latency and errors,
+    scrape throughput and queue depth, cache hit rates and process memory.
+    """
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
+def check_admin_token():
+    """Return an error response unless debug routes are enabled and the request carries the admin token."""
+    if not PROFILER_ADMIN_TOKEN:
+        return jsonify({'error': 'Not found'}), 404
+    token = request.headers.get('X-Admin-Token', '')
+    if not hmac.compare_digest(token.encode('utf-8'), PROFILER_ADMIN_TOKEN.encode('utf-8')):
+        return jsonify({'error': 'Invalid admin token'}), 403
+    return None
+
+
+@app.route('/debug/profiler', methods=['GET', 'POST'])
+def debug_profiler():
+    """
+    Switch the sampling profiler on or off at runtime. Requires the X-Admin-Token header.
+    JSON Body: { "enabled": true, "threshold_ms": 1000 }
+    While it is on, requests slower than threshold_ms have their sampled stacks saved to PROFILE_DIR.
+    """
+    error = check_admin_token()
+    if error:
+        return error
+
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        if 'threshold_ms' in data:
+            try:
+                threshold_ms = float(data['threshold_ms'])
+            except (TypeError, ValueError):
+                return jsonify({'error': 'threshold_ms must be a number'}), 400
+            if not threshold_ms >= PROFILER_MIN_THRESHOLD_MS:
+                return jsonify({'error': f'threshold_ms must be at least {PROFILER_MIN_THRESHOLD_MS}'}), 400
+            profiler["threshold_ms"] = threshold_ms
+        enabled = bool(data.get('enabled', profiler["enabled"]))
+        with profiler_lock:
+            profiler["enabled"] = enabled
+            # A sampler that has not seen the switch-off yet simply keeps running
+            if enabled and profiler["sampler"] is None:
+                profiler["sampler"] = threading.Thread(target=run_profiler, daemon=True)
+                profiler["sampler"].start()
+
+    profiles = sorted(os.listdir(PROFILE_DIR)) if os.path.isdir(PROFILE_DIR) else []
+    return jsonify({"enabled": profiler["enabled"], "threshold_ms": profiler["threshold_ms"], "profiles": profiles})
+
+
+@app.route('/debug/profiles/<filename>', methods=['GET'])
+def debug_profile(filename):
+    """Download a saved profile. Requires the X-Admin-Token header."""
+    error = check_admin_token()
+    if error:
+        return error
+    return send_from_directory(os.path.abspath(PROFILE_DIR), filename, mimetype='text/plain')
 
 
 @app.route('/privacy', methods=['GET'])
@@ -121,56 +1086,318 @@ def list_channels():
     List all Slack channels.
     """
     try:
-        response = client.conversations_list(types="public_channel,private_channel")
+        response = upstream_reads.do(('list_channels',), call_upstream, 'slack.conversations_list',
+                                     client.conversations_list, types="public_channel,private_channel")
         channels = response.get("channels", [])
         return jsonify({"ok": True, "channels": [{"id": ch["id"], "name": ch["name"]} for ch in channels]})
     except SlackApiError as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
-# Authentication flow (unchanged)
+# Authentication flow
 @app.route('/startAuth', methods=['GET'])
 def start_auth():
-    flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRET_FILE, SCOPES)
+    user_id = get_caller_id()
+    if user_id is None:
+        return jsonify({'error': 'X-User-Id header is required'}), 401
+
+    # The OAuth state ties the Google callback back to the user who started the sign-in
+    state = secrets.token_urlsafe(32)
+    now = time.time()
+    with pending_auth_states_lock:
+        for expired in [key for key, (_, started) in pending_auth_states.items() if now - started > AUTH_STATE_TTL]:
+            del pending_auth_states[expired]
+        pending_auth_states[state] = (user_id, now)
+
+    flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRET_FILE, SCOPES, state=state)
     flow.redirect_uri = 'https://48c3-2407-d000-1a-8ad4-ad85-aa2a-1087-948e.ngrok-free.app/handleAuth'
     auth_url, _ = flow.authorization_url(prompt='consent')
     return jsonify({'auth_url': auth_url}), 200
 
 @app.route('/handleAuth', methods=['GET'])
 def handle_auth():
-    flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRET_FILE, SCOPES)
+    state = request.args.get('state')
+    with pending_auth_states_lock:
+        user_id, started = pending_auth_states.pop(state, (None, 0))
+    if user_id is None or time.time() - started > AUTH_STATE_TTL:
+        return jsonify({'error': 'Unknown or expired sign-in. Please authenticate again at /startAuth'}), 400
+
+    flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRET_FILE, SCOPES, state=state)
     flow.redirect_uri = 'https://48c3-2407-d000-1a-8ad4-ad85-aa2a-1087-948e.ngrok-free.app/handleAuth'
     authorization_response = request.url
     flow.fetch_token(authorization_response=authorization_response)
 
-    creds = flow.credentials
-    with open(TOKEN_FILE, 'w') as token_file:
-        token_file.write(creds.to_json())
+    # The user's Drive mirror and search index may belong to a previous Google account, so rebuild them
+    mirror_path = drive_mirror_path(user_id)
+    if os.path.exists(mirror_path):
+        os.remove(mirror_path)
+    user_sessions.set_credentials(user_id, flow.credentials)
+    # Reset after replacing the session, so an indexing pass still running for the old session
+    # either has its writes removed here or skips them
+    reset_search_index(user_id)
 
     return jsonify({'message': 'Authentication successful!'}), 200
 
+
+def drive_mirror_path(user_id):
+    return os.path.join(DRIVE_MIRROR_DIR, f"{user_key(user_id)}.json")
+
+
+def save_drive_mirror(session):
+    """Persist the user's Drive mirror so a restart resumes from the stored page token."""
+    drive_mirror = session["drive_mirror"]
+    os.makedirs(DRIVE_MIRROR_DIR, exist_ok=True)
+    write_file_atomic(drive_mirror_path(session["user_id"]),
+                      json.dumps({"files": drive_mirror["files"], "page_token": drive_mirror["page_token"]}))
+
+
+def seed_drive_mirror(drive_service, drive_mirror):
+    """Seed a Drive mirror with a full paginated listing."""
+    # Take the start page token first so changes made during the listing are not missed
+    start_page_token = call_upstream('drive', drive_service.changes().getStartPageToken().execute).get('startPageToken')
+
+    files = {}
+    page_token = None
+    while True:
+        results = call_upstream('drive', drive_service.files().list(
+            pageSize=1000,
+            fields=f"nextPageToken, files({DRIVE_FILE_FIELDS})",
+            q="trashed = false",
+            pageToken=page_token
+        ).execute)
+        for file in results.get('files', []):
+            files[file['id']] = file
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+    drive_mirror["files"] = files
+    drive_mirror["page_token"] = start_page_token
+    print(f"Drive mirror seeded with {len(files)} files.")
+
+
+def apply_drive_changes(drive_service, drive_mirror):
+    """Apply everything that changed in Drive since the mirror's stored page token."""
+    page_token = drive_mirror["page_token"]
+    changed = 0
+    while page_token:
+        results = call_upstream('drive', drive_service.changes().list(
+            pageToken=page_token,
+            pageSize=1000,
+            fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({DRIVE_FILE_FIELDS}))"
+        ).execute)
+        for change in results.get('changes', []):
+            file = change.get('file')
+            if change.get('removed') or not file or file.get('trashed'):
+                drive_mirror["files"].pop(change['fileId'], None)
+            else:
+                drive_mirror["files"][change['fileId']] = file
+            changed += 1
+
+        if 'newStartPageToken' in results:
+            drive_mirror["page_token"] = results['newStartPageToken']
+            break
+        page_token = results.get('nextPageToken')
+    return changed
+
+
+def build_drive_snapshot(files):
+    """
+    Sort the mirror once per /listFiles order. Each order maps to a list of (value, id) keys and
+    the files in the same order, so a cursor is found with bisect instead of a scan.
+    """
+    snapshot = {}
+    for field in LIST_FILES_SORT_FIELDS:
+        ordered = sorted(files.values(), key=lambda f: (f.get(field, ''), f['id']))
+        snapshot[field] = ([(f.get(field, ''), f['id']) for f in ordered], ordered)
+    return snapshot
+
+
+def sync_drive_mirror(session, force=False):
+    """Bring the user's Drive mirror up to date, polling the Changes API at most once per sync interval."""
+    drive_mirror = session["drive_mirror"]
+    with session["drive_mirror_lock"]:
+        mirror_path = drive_mirror_path(session["user_id"])
+        if not drive_mirror["page_token"] and os.path.exists(mirror_path):
+            with open(mirror_path, 'r') as mirror_file:
+                stored = json.load(mirror_file)
+            drive_mirror["files"] = stored.get("files", {})
+            drive_mirror["page_token"] = stored.get("page_token")
+
+        if force or time.time() - drive_mirror["synced_at"] >= DRIVE_MIRROR_SYNC_INTERVAL:
+            drive_service = user_sessions.get_service(session["user_id"], 'drive', 'v3')
+            if drive_mirror["page_token"]:
+                changed = apply_drive_changes(drive_service, drive_mirror)
+            else:
+                seed_drive_mirror(drive_service, drive_mirror)
+                changed = len(drive_mirror["files"])
+
+            drive_mirror["synced_at"] = time.time()
+            # The user signed in again meanwhile and their stored mirror was removed; this sync is stale
+            if changed and user_sessions.cached(session["user_id"]) is session:
+                save_drive_mirror(session)
+        else:
+            changed = 0
+
+        if changed or drive_mirror["snapshot"] is None:
+            drive_mirror["snapshot"] = build_drive_snapshot(drive_mirror["files"])
+
+
+def request_drive_sync(session, force=False):
+    """
+    Queue a background sync of the user's Drive mirror once the sync interval has passed,
+    or right away with force. Requests keep serving the previous snapshot meanwhile.
+    """
+    drive_mirror = session["drive_mirror"]
+    if not force and time.time() - drive_mirror["synced_at"] < DRIVE_MIRROR_SYNC_INTERVAL:
+        CACHE_REQUESTS.labels(cache='drive_mirror', result='hit').inc()
+        return
+    CACHE_REQUESTS.labels(cache='drive_mirror', result='miss').inc()
+
+    task_id = f"drive-sync-{user_key(session['user_id'])}"
+    if not scheduler.is_pending(task_id):
+        scheduler.submit('default', task_id, session["user_id"], sync_drive_mirror, session, force)
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by encode_cursor. Raises ValueError unless it is a (value, id) pair of strings."""
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    if not isinstance(key, list) or len(key) != 2 or not all(isinstance(part, str) for part in key):
+        raise ValueError("Invalid cursor")
+    return key
+
+
 # List Google Docs-compatible files
 @app.route('/listFiles', methods=['GET'])
 def list_files():
+    """
+    Lists files from the last snapshot of the local Drive mirror, which is synced in the background.
+    Query parameters: name_prefix, mimeType (defaults to Google Docs, "all" for every type),
+    modified_after, folder_id, order_by (name or modifiedTime, "-" prefix for descending),
+    page_size, cursor (the next_cursor of the previous page) and refresh (sync now).
+    """
+    name_prefix = request.args.get('name_prefix', '').lower()
+    mime_type = request.args.get('mimeType', GOOGLE_DOC_MIME_TYPE)
+    modified_after = request.args.get('modified_after')
+    folder_id = request.args.get('folder_id')
+    order_by = request.args.get('order_by', 'name')
+    cursor = request.args.get('cursor')
+
+    descending = order_by.startswith('-')
+    sort_field = order_by.lstrip('-')
+    if sort_field not in LIST_FILES_SORT_FIELDS:
+        return jsonify({'error': 'order_by must be name or modifiedTime'}), 400
+
     try:
-        if os.path.exists(TOKEN_FILE):
-            with open(TOKEN_FILE, 'r') as token_file:
-                creds_json = json.load(token_file)
-                creds = Credentials.from_authorized_user_info(creds_json)
-        else:
+        page_size = min(max(int(request.args.get('page_size', 100)), 1), 1000)
+        after_key = tuple(decode_cursor(cursor)) if cursor else None
+    except ValueError:
+        return jsonify({'error': 'Invalid page_size or cursor'}), 400
+
+    try:
+        session = user_sessions.get(get_caller_id())
+        if session is None:
             return jsonify({'error': 'User not authenticated. Please authenticate at /startAuth'}), 401
 
-        drive_service = build('drive', 'v3', credentials=creds)
-        results = drive_service.files().list(
-            pageSize=10,
-            fields="files(id, name, mimeType)",
-            q="mimeType='application/vnd.google-apps.document'"
-        ).execute()
-        files = results.get('files', [])
+        request_drive_sync(session, force=request.args.get('refresh') == 'true')
+        snapshot = session["drive_mirror"]["snapshot"]
+        if snapshot is None:
+            response = jsonify({'error': 'Your Drive file list is still being built. Please try again shortly.'})
+            response.headers['Retry-After'] = str(DRIVE_MIRROR_RETRY_AFTER)
+            return response, 503
+
+        # Files are ordered on (value, id), so the cursor is a stable position in the ordering
+        keys, ordered = snapshot[sort_field]
+        if descending:
+            start = bisect.bisect_left(keys, after_key) if after_key else len(keys)
+            positions = range(start - 1, -1, -1)
+        else:
+            positions = range(bisect.bisect_right(keys, after_key) if after_key else 0, len(keys))
 
-        return jsonify({'files': files})
+        page = []
+        next_cursor = None
+        for position in positions:
+            file = ordered[position]
+            if mime_type != 'all' and file.get('mimeType') != mime_type:
+                continue
+            if name_prefix and not file.get('name', '').lower().startswith(name_prefix):
+                continue
+            if modified_after and file.get('modifiedTime', '') <= modified_after:
+                continue
+            if folder_id and folder_id not in file.get('parents', []):
+                continue
+            if len(page) == page_size:
+                last = page[-1]
+                next_cursor = encode_cursor([last.get(sort_field, ''), last['id']])
+                break
+            page.append(file)
+
+        return jsonify({
+            'files': [{'id': f['id'], 'name': f.get('name'), 'mimeType': f.get('mimeType'),
+                       'modifiedTime': f.get('modifiedTime'), 'parents': f.get('parents', [])} for f in page],
+            'next_cursor': next_cursor
+        })
+    except UpstreamError:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def extract_doc_text(document):
+    """
+    Extract the plain text of a Google Docs document.
+    Returns the text and a list of (text_offset, start_index) pairs, one per text run,
+    which map positions in the text back to document indices.
+    """
+    content = []
+    runs = []
+    offset = 0
+    doc_index = 1
+    for element in document.get('body', {}).get('content', []):
+        if 'paragraph' in element:
+            for text_run in element['paragraph'].get('elements', []):
+                if 'textRun' in text_run:
+                    text = text_run['textRun']['content']
+                    doc_index = text_run.get('startIndex', doc_index)
+                    runs.append((offset, doc_index))
+                    content.append(text)
+                    offset += len(text)
+                    doc_index += utf16_length(text)
+    return ''.join(content), runs
+
+
+def utf16_length(text):
+    """Length of text in UTF-16 code units, which is what Google Docs indices count."""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def doc_index_for_offset(runs, text, text_offset):
+    """Map an offset in the extracted text to a Google Docs index."""
+    position = bisect.bisect_right([run[0] for run in runs], text_offset) - 1
+    if position < 0:
+        return utf16_length(text[:text_offset]) + 1
+    run_offset, start_index = runs[position]
+    return start_index + utf16_length(text[run_offset:text_offset])
+
+
+def text_offset_for_doc_index(runs, text, doc_index):
+    """Map a Google Docs index to an offset in the extracted text."""
+    position = bisect.bisect_right([run[1] for run in runs], doc_index) - 1
+    if position < 0:
+        return 0
+    run_offset, start_index = runs[position]
+    run_end = runs[position + 1][0] if position + 1 < len(runs) else len(text)
+    # Walk the run in UTF-16 units; an index inside a surrogate pair rounds up to the next character
+    offset = run_offset
+    units = doc_index - start_index
+    while units > 0 and offset < run_end:
+        units -= utf16_length(text[offset])
+        offset += 1
+    return offset
+
+
 # Read a Google Docs file
 @app.route('/readDoc', methods=['GET'])
 def read_doc():
@@ -180,25 +1407,19 @@ def read_doc():
         return jsonify({'error': 'Document ID is required'}), 400
 
     try:
-        if os.path.exists(TOKEN_FILE):
-            with open(TOKEN_FILE, 'r') as token_file:
-                creds_json = json.load(token_file)
-                creds = Credentials.from_authorized_user_info(creds_json)
-        else:
+        documents = user_sessions.get_service(get_caller_id(), 'docs', 'v1', 'documents')
+        if documents is None:
             return jsonify({'error': 'User not authenticated. Please authenticate at /startAuth'}), 401
 
-        docs_service = build('docs', 'v1', credentials=creds)
-
         # Retrieve the document content
-        document = docs_service.documents().get(documentId=doc_id).execute()
-        content = []
-        for element in document.get('body', {}).get('content', []):
-            if 'paragraph' in element:
-                for text_run in element['paragraph'].get('elements', []):
-                    if 'textRun' in text_run:
-                        content.append(text_run['textRun']['content'])
-
-        return jsonify({'content': ''.join(content)})
+        # Build the request inside the closure, so requests that join an in-flight read skip that work
+        document = upstream_reads.do(('readDoc', get_caller_id(), doc_id),
+                                     lambda: call_upstream('docs', documents.get(documentId=doc_id).execute))
+        content, _ = extract_doc_text(document)
+
+        return jsonify({'content': content})
+    except UpstreamError:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -217,15 +1438,10 @@ def update_doc():
         return jsonify({'error': 'Document ID and content are required'}), 400
 
     try:
-        if os.path.exists(TOKEN_FILE):
-            with open(TOKEN_FILE, 'r') as token_file:
-                creds_json = json.load(token_file)
-                creds = Credentials.from_authorized_user_info(creds_json)
-        else:
+        documents = user_sessions.get_service(get_caller_id(), 'docs', 'v1', 'documents')
+        if documents is None:
             return jsonify({'error': 'User not authenticated. Please authenticate at /startAuth'}), 401
 
-        docs_service = build('docs', 'v1', credentials=creds)
-
         # Request body to update the document
         requests = [
             {
@@ -238,27 +1454,348 @@ def update_doc():
             }
         ]
 
-        docs_service.documents().batchUpdate(documentId=doc_id, body={"requests": requests}).execute()
+        call_upstream('docs', documents.batchUpdate(documentId=doc_id, body={"requests": requests}).execute, idempotent=False)
 
         return jsonify({'message': f'Content updated successfully in document: {doc_id}'})
+    except UpstreamError:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-def initialize_google_drive():
-    """Initialize Google Drive API."""
-    global drive_service
-    try:
-        if os.path.exists(TOKEN_FILE):
-            with open(TOKEN_FILE, 'r') as token_file:
-                creds_json = json.load(token_file)
-                creds = Credentials.from_authorized_user_info(creds_json)
+
+def diff_text(old, new):
+    """
+    Compute the edits that turn old into new as (i1, i2, j1, j2) tuples:
+    old[i1:i2] is replaced by new[j1:j2]. Edits are sorted and never overlap.
+
+    The common prefix and suffix are stripped first, then the rest is diffed line by line
+    and only the changed line blocks are diffed character by character, or word by word when
+    they are larger, which keeps small edits to large documents fast.
+    """
+    prefix = len(os.path.commonprefix([old, new]))
+    max_suffix = min(len(old), len(new)) - prefix
+    suffix = len(os.path.commonprefix([old[::-1][:max_suffix], new[::-1][:max_suffix]]))
+    old_end = len(old) - suffix
+    new_end = len(new) - suffix
+
+    old_lines = old[prefix:old_end].splitlines(keepends=True)
+    new_lines = new[prefix:new_end].splitlines(keepends=True)
+    old_starts = [prefix]
+    for line in old_lines:
+        old_starts.append(old_starts[-1] + len(line))
+    new_starts = [prefix]
+    for line in new_lines:
+        new_starts.append(new_starts[-1] + len(line))
+
+    edits = []
+    line_matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, a1, a2, b1, b2 in line_matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        i1, i2, j1, j2 = old_starts[a1], old_starts[a2], new_starts[b1], new_starts[b2]
+
+        # Character- or word-level diff of a changed block, unless it is too large to be worth it
+        block_size = (i2 - i1) + (j2 - j1)
+        if tag == 'replace' and block_size <= MAX_CHAR_DIFF_SIZE:
+            edits.extend(diff_tokens(list(old[i1:i2]), list(new[j1:j2]), i1, j1, autojunk=False))
+        elif tag == 'replace' and block_size <= MAX_WORD_DIFF_SIZE:
+            # Very common words and spaces are skipped as match anchors, or the diff turns quadratic
+            edits.extend(diff_tokens(re.findall(r'\s+|\S+', old[i1:i2]), re.findall(r'\s+|\S+', new[j1:j2]),
+                                     i1, j1, autojunk=True))
         else:
-            raise Exception("User not authenticated. Please authenticate at /startAuth")
+            edits.append((i1, i2, j1, j2))
+    return edits
+
+
+def diff_tokens(old_tokens, new_tokens, old_start, new_start, autojunk):
+    """Diff two token lists that join to old and new text starting at old_start and new_start."""
+    old_offsets = list(itertools.accumulate((len(token) for token in old_tokens), initial=old_start))
+    new_offsets = list(itertools.accumulate((len(token) for token in new_tokens), initial=new_start))
+    matcher = difflib.SequenceMatcher(None, old_tokens, new_tokens, autojunk=autojunk)
+    return [(old_offsets[a1], old_offsets[a2], new_offsets[b1], new_offsets[b2])
+            for tag, a1, a2, b1, b2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def build_diff_requests(edits, runs, text, new, text_offset=0):
+    """
+    Turn text edits into Docs batchUpdate requests. runs and text are the extracted document
+    the edits were computed against; the edited section starts at text_offset in text.
+    Edits are applied from the end of the document backwards so earlier indices stay valid.
+    """
+    doc_requests = []
+    for i1, i2, j1, j2 in reversed(edits):
+        start_index = doc_index_for_offset(runs, text, text_offset + i1)
+        if i2 > i1:
+            last = text_offset + i2 - 1
+            end_index = doc_index_for_offset(runs, text, last) + utf16_length(text[last])
+            doc_requests.append({
+                'deleteContentRange': {'range': {'startIndex': start_index, 'endIndex': end_index}}
+            })
+        if j2 > j1:
+            doc_requests.append({
+                'insertText': {'location': {'index': start_index}, 'text': new[j1:j2]}
+            })
+    return doc_requests
+
+
+@app.route('/replaceDocContent', methods=['POST'])
+def replace_doc_content():
+    """
+    Replaces the content of a Google Docs file, or of a section between start_index and end_index,
+    with the given text. Only the minimal delete/insert operations are sent, so unchanged text
+    keeps its formatting.
+    """
+    data = request.json
+    doc_id = data.get('document_id')
+    content = data.get('content')
+    start_index = data.get('start_index')
+    end_index = data.get('end_index')
+
+    if not doc_id or content is None:
+        return jsonify({'error': 'Document ID and content are required'}), 400
+    for index in (start_index, end_index):
+        if index is not None and (not isinstance(index, int) or isinstance(index, bool) or index < 1):
+            return jsonify({'error': 'start_index and end_index must be integers of at least 1'}), 400
+    if start_index is not None and end_index is not None and end_index < start_index:
+        return jsonify({'error': 'end_index must not be less than start_index'}), 400
+
+    try:
+        documents = user_sessions.get_service(get_caller_id(), 'docs', 'v1', 'documents')
+        if documents is None:
+            return jsonify({'error': 'User not authenticated. Please authenticate at /startAuth'}), 401
+        document = call_upstream('docs', documents.get(documentId=doc_id).execute)
+        text, runs = extract_doc_text(document)
+
+        section_start = text_offset_for_doc_index(runs, text, start_index) if start_index is not None else 0
+        section_end = text_offset_for_doc_index(runs, text, end_index) if end_index is not None else len(text)
+        section_start = max(0, min(section_start, len(text)))
+        section_end = max(section_start, min(section_end, len(text)))
+
+        # The final newline of a document can never be deleted, so leave it out of the diff
+        if section_end == len(text) and text.endswith('\n'):
+            section_end -= 1
+            if content.endswith('\n'):
+                content = content[:-1]
+        section_start = min(section_start, section_end)
+
+        edits = diff_text(text[section_start:section_end], content)
+        doc_requests = build_diff_requests(edits, runs, text, content, section_start)
+
+        if doc_requests:
+            body = {"requests": doc_requests}
+            if document.get('revisionId'):
+                # Fail instead of clobbering edits made since the document was read
+                body["writeControl"] = {"requiredRevisionId": document['revisionId']}
+            call_upstream('docs', documents.batchUpdate(documentId=doc_id, body=body).execute, idempotent=False)
+
+        return jsonify({
+            'message': f'Content replaced successfully in document: {doc_id}',
+            'operations': len(doc_requests),
+            'deleted_characters': sum(i2 - i1 for i1, i2, _, _ in edits),
+            'inserted_characters': sum(j2 - j1 for _, _, j1, j2 in edits)
+        })
+    except UpstreamError:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+SEARCH_INDEX_SCHEMA_VERSION = 2  # Version 2 added user_id, so each user only searches their own Docs
+# A word as the unicode61 tokenizer sees it: letters and digits, with any combining marks
+SEARCH_TOKEN_PATTERN = re.compile(r'(?:[^\W_]|[\u0300-\u036f])+')
+
+
+def fold_search_token(token):
+    """Fold a word the way unicode61 does before comparing it: case-insensitive, diacritics removed."""
+    token = token.lower()
+    if token.isascii():
+        return token
+    return ''.join(char for char in unicodedata.normalize('NFD', token) if not unicodedata.combining(char))
+
+
+def open_search_index():
+    """Open the SQLite full-text index, creating its tables on first use."""
+    conn = sqlite3.connect(SEARCH_INDEX_FILE, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    if conn.execute("PRAGMA user_version").fetchone()[0] < SEARCH_INDEX_SCHEMA_VERSION:
+        # The index is rebuilt from Drive, so an old layout is simply dropped
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS indexed_docs")
+            conn.execute("DROP TABLE IF EXISTS doc_text")
+            conn.execute(f"PRAGMA user_version = {SEARCH_INDEX_SCHEMA_VERSION}")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS indexed_docs ("
+        "user_id TEXT, document_id TEXT, name TEXT, modified_time TEXT, revision_id TEXT, runs TEXT, "
+        "PRIMARY KEY (user_id, document_id))"
+    )
+    conn.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS doc_text USING fts5("
+        "user_id UNINDEXED, document_id UNINDEXED, name, content, tokenize='unicode61')"
+    )
+    return conn
+
+
+def reset_search_index(user_id):
+    """Drop a user's documents from the search index."""
+    with search_index_lock:
+        conn = open_search_index()
+        with conn:
+            conn.execute("DELETE FROM indexed_docs WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM doc_text WHERE user_id = ?", (user_id,))
+        conn.close()
+
+
+def index_google_docs(session, task_id=None):
+    """
+    Bring a user's part of the search index up to date with their Drive mirror.
+    Only Docs whose modifiedTime changed since they were last indexed are fetched again.
+    Run as the scheduler job task_id, the pass stops early when the job is cancelled.
+    """
+    user_id = session["user_id"]
+    documents = user_sessions.get_service(user_id, 'docs', 'v1', 'documents')
+    sync_drive_mirror(session)
+
+    with session["drive_mirror_lock"]:
+        docs = {file_id: file for file_id, file in session["drive_mirror"]["files"].items()
+                if file.get('mimeType') == GOOGLE_DOC_MIME_TYPE}
+
+    # Docs are fetched without holding search_index_lock; it is only taken for the short write
+    # transactions, and WAL lets searches read meanwhile
+    conn = open_search_index()
+    try:
+        indexed = dict(conn.execute(
+            "SELECT document_id, modified_time FROM indexed_docs WHERE user_id = ?", (user_id,)))
+
+        # Forget documents that were deleted, trashed or are no longer Docs
+        removed = set(indexed) - set(docs)
+        if removed:
+            with search_index_lock, conn:
+                if user_sessions.cached(user_id) is not session:
+                    return
+                for document_id in removed:
+                    conn.execute("DELETE FROM indexed_docs WHERE user_id = ? AND document_id = ?",
+                                 (user_id, document_id))
+                    conn.execute("DELETE FROM doc_text WHERE user_id = ? AND document_id = ?",
+                                 (user_id, document_id))
+
+        updated = 0
+        for document_id, file in docs.items():
+            if indexed.get(document_id) == file.get('modifiedTime'):
+                continue
+            if task_id and scheduler.is_cancelled(task_id):
+                break
+            try:
+                document = call_upstream('docs', documents.get(documentId=document_id).execute)
+            except Exception as e:
+                print(f"Failed to index document {document_id}: {e}")
+                continue
+
+            content, runs = extract_doc_text(document)
+            with search_index_lock, conn:
+                # The user signed in again meanwhile and their index was reset; this pass is stale
+                if user_sessions.cached(user_id) is not session:
+                    return
+                conn.execute("DELETE FROM doc_text WHERE user_id = ? AND document_id = ?",
+                             (user_id, document_id))
+                conn.execute("INSERT INTO doc_text (user_id, document_id, name, content) VALUES (?, ?, ?, ?)",
+                             (user_id, document_id, file.get('name'), content))
+                conn.execute(
+                    "INSERT OR REPLACE INTO indexed_docs "
+                    "(user_id, document_id, name, modified_time, revision_id, runs) VALUES (?, ?, ?, ?, ?, ?)",
+                    (user_id, document_id, file.get('name'), file.get('modifiedTime'),
+                     document.get('revisionId'), json.dumps(runs))
+                )
+            updated += 1
+    finally:
+        conn.close()
+
+    if updated:
+        print(f"Search index updated: {updated} documents re-indexed.")
+
+
+def schedule_search_indexing():
+    """Queue an indexing pass for every user with cached credentials whose last pass has finished."""
+    for session in user_sessions.list():
+        task_id = f"search-index-{user_key(session['user_id'])}"
+        if not scheduler.is_pending(task_id):
+            scheduler.submit('default', task_id, session["user_id"], index_google_docs, session, task_id,
+                             priority=SEARCH_INDEX_PRIORITY)
+
+
+def start_search_indexer():
+    """Have the scheduler keep the search index current in the background."""
+    scheduler.every(SEARCH_INDEX_INTERVAL, schedule_search_indexing)
+    print("Search indexer started.")
+
+
+@app.route('/searchDocs', methods=['GET'])
+def search_docs():
+    """
+    Full-text search across the user's Google Docs.
+    Returns ranked snippets with document IDs and the document indices of each match,
+    which can be passed to /updateDoc as location_index.
+    """
+    # Search on the same word tokens FTS5 indexes, so match offsets can be found in the text
+    terms = SEARCH_TOKEN_PATTERN.findall(request.args.get('q', ''))
+    if not terms:
+        return jsonify({'error': 'Query parameter q is required'}), 400
+
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), 100)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
 
-        drive_service = build('drive', 'v3', credentials=creds)
-        print("Google Drive service initialized.")
+    # Quote every term so words like AND/OR/NOT are never parsed as FTS5 operators
+    match_expression = " ".join(f'"{term}"' for term in terms)
+
+    user_id = get_caller_id()
+    if user_id is None:
+        return jsonify({'error': 'User not authenticated. Please authenticate at /startAuth'}), 401
+
+    try:
+        conn = open_search_index()
+        try:
+            rows = conn.execute(
+                "SELECT doc_text.document_id, doc_text.name, doc_text.content, "
+                "snippet(doc_text, 3, '[', ']', '...', 16), bm25(doc_text), indexed_docs.runs "
+                "FROM doc_text JOIN indexed_docs ON indexed_docs.user_id = doc_text.user_id "
+                "AND indexed_docs.document_id = doc_text.document_id "
+                "WHERE doc_text MATCH ? AND doc_text.user_id = ? ORDER BY bm25(doc_text) LIMIT ?",
+                (match_expression, user_id, limit)
+            ).fetchall()
+            indexed_count = conn.execute(
+                "SELECT COUNT(*) FROM indexed_docs WHERE user_id = ?", (user_id,)).fetchone()[0]
+        finally:
+            conn.close()
+
+        results = []
+        folded_terms = {fold_search_token(term): term.lower() for term in terms}
+        for document_id, name, content, snippet, score, runs_json in rows:
+            runs = json.loads(runs_json)
+            # Whole words that fold to a query term, as FTS5 matched them; indices and lengths are in
+            # UTF-16 code units like every Docs index
+            matches = []
+            for word in SEARCH_TOKEN_PATTERN.finditer(content):
+                term = folded_terms.get(fold_search_token(word.group()))
+                if term is None:
+                    continue
+                matches.append({
+                    'term': term,
+                    'index': doc_index_for_offset(runs, content, word.start()),
+                    'length': utf16_length(word.group())
+                })
+                if len(matches) == 20:
+                    break
+            results.append({
+                'document_id': document_id,
+                'name': name,
+                'snippet': snippet,
+                'score': -score,
+                'matches': matches
+            })
+
+        return jsonify({'results': results, 'indexed_documents': indexed_count})
     except Exception as e:
-        print(f"Failed to initialize Google Drive: {e}")
+        return jsonify({'error': str(e)}), 500
 
 def initialize_selenium():
     """Initialize Selenium WebDriver."""
@@ -281,26 +1818,30 @@ def initialize_selenium():
         print(f"Failed to initialize Selenium: {selenium_error_message}")
 
 
-def upload_to_google_drive(file_path, folder_id):
+def upload_to_google_drive(drive_service, file_path, folder_id, mimetype='text/html', resumable=False):
     """Upload a file to Google Drive."""
     try:
         file_metadata = {
             'name': os.path.basename(file_path),
             'parents': [folder_id]
         }
-        media = googleapiclient.http.MediaFileUpload(file_path, mimetype='text/html')
-        uploaded_file = drive_service.files().create(
+        if resumable:
+            media = googleapiclient.http.MediaFileUpload(
+                file_path, mimetype=mimetype, resumable=True, chunksize=RESUMABLE_CHUNK_SIZE)
+        else:
+            media = googleapiclient.http.MediaFileUpload(file_path, mimetype=mimetype)
+        uploaded_file = call_upstream('drive', drive_service.files().create(
             body=file_metadata,
             media_body=media,
             fields='id, name'
-        ).execute()
+        ).execute, idempotent=False)
         return uploaded_file.get('id'), uploaded_file.get('name')
     except Exception as e:
         print(f"Error uploading file to Google Drive: {e}")
         return None, None
 
 
-def create_google_drive_folder(folder_name, parent_folder_id=None):
+def create_google_drive_folder(drive_service, folder_name, parent_folder_id=None):
     """Create a folder in Google Drive."""
     try:
         folder_metadata = {
@@ -310,10 +1851,10 @@ def create_google_drive_folder(folder_name, parent_folder_id=None):
         if parent_folder_id:
             folder_metadata['parents'] = [parent_folder_id]
 
-        folder = drive_service.files().create(
+        folder = call_upstream('drive', drive_service.files().create(
             body=folder_metadata,
             fields='id, name'
-        ).execute()
+        ).execute, idempotent=False)
 
         print(f"Folder '{folder_name}' created with ID: {folder.get('id')}")
         return folder.get('id')
@@ -322,7 +1863,7 @@ def create_google_drive_folder(folder_name, parent_folder_id=None):
         return None
 
 
-def save_page(url, content, parent_folder_id):
+def save_page(drive_service, url, content, parent_folder_id):
     """Save HTML content directly to a sub-folder in Google Drive."""
     parsed_url = urlparse(url)
     filename = parsed_url.path.strip("/").replace("/", "_") or "index"
@@ -333,13 +1874,148 @@ def save_page(url, content, parent_folder_id):
         file.write(content)
 
     # Upload file to Google Drive
-    file_id, file_name = upload_to_google_drive(temp_file_path, parent_folder_id)
+    file_id, file_name = upload_to_google_drive(drive_service, temp_file_path, parent_folder_id)
     os.remove(temp_file_path)  # Clean up the local temp file
 
     return file_id, file_name
 
 
-def scrape_pages_with_selenium(task_id, base_url, max_pages, root_folder_id):
+def build_warc_record(url, content):
+    """Build a WARC resource record holding the HTML content of a page."""
+    header = (
+        "WARC/1.1\r\n"
+        "WARC-Type: resource\r\n"
+        f"WARC-Record-ID: <urn:uuid:{uuid.uuid4()}>\r\n"
+        f"WARC-Date: {time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}\r\n"
+        f"WARC-Target-URI: {url}\r\n"
+        "Content-Type: text/html\r\n"
+        f"Content-Length: {len(content)}\r\n"
+        "\r\n"
+    )
+    return header.encode("utf-8") + content + b"\r\n\r\n"
+
+
+def parse_warc_record(record):
+    """Return the content block of a single WARC record."""
+    header, _, body = record.partition(b"\r\n\r\n")
+    for line in header.decode("utf-8").split("\r\n"):
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "content-length":
+            return body[:int(value.strip())]
+    return body
+
+
+class BundleWriter:
+    """
+    Streams scraped pages into gzip'd WARC shards and uploads each shard to Google Drive
+    with a resumable upload once it reaches the configured size.
+
+    Every page is compressed as its own gzip member, so the JSON index of
+    URL -> shard/offset/length is enough to fetch a page back with a ranged read.
+    """
+
+    def __init__(self, drive_service, task_id, folder_id, shard_size):
+        self.drive_service = drive_service
+        self.task_id = task_id
+        self.folder_id = folder_id
+        self.shard_size = shard_size
+        self.shards = []
+        self.pages = {}
+        self.shard_file = None
+        self.shard_path = None
+
+    def _open_shard(self):
+        shard_name = f"{self.task_id}-{len(self.shards):05d}.warc.gz"
+        self.shard_path = os.path.join(OUTPUT_DIR, shard_name)
+        self.shard_file = open(self.shard_path, "wb")
+        self.shards.append({"name": shard_name, "file_id": None})
+
+    def _close_shard(self):
+        self.shard_file.close()
+        self.shard_file = None
+
+        file_id, _ = upload_to_google_drive(self.drive_service, self.shard_path, self.folder_id,
+                                            mimetype='application/gzip', resumable=True)
+        os.remove(self.shard_path)  # Clean up the local shard
+        if not file_id:
+            raise Exception(f"Failed to upload bundle shard {self.shards[-1]['name']} to Google Drive.")
+        self.shards[-1]["file_id"] = file_id
+
+    def add_page(self, url, content):
+        """Append a page to the current shard, rolling over to a new shard when it is full."""
+        if self.shard_file is None:
+            self._open_shard()
+
+        record = gzip.compress(build_warc_record(url, content))
+        offset = self.shard_file.tell()
+        self.shard_file.write(record)
+        self.pages[url] = {"shard": len(self.shards) - 1, "offset": offset, "length": len(record)}
+
+        if self.shard_file.tell() >= self.shard_size:
+            self._close_shard()
+
+    def close(self, base_url):
+        """Upload the last shard and the JSON index. Returns the index file ID."""
+        if self.shard_file is not None:
+            self._close_shard()
+
+        index = {
+            "base_url": base_url,
+            "format": "warc.gz",
+            "shards": self.shards,
+            "pages": self.pages,
+        }
+        index_path = os.path.join(OUTPUT_DIR, f"{self.task_id}-index.json")
+        with open(index_path, "w") as index_file:
+            json.dump(index, index_file)
+
+        index_id, _ = upload_to_google_drive(self.drive_service, index_path, self.folder_id,
+                                             mimetype='application/json')
+        os.remove(index_path)
+        if not index_id:
+            raise Exception("Failed to upload bundle index to Google Drive.")
+        return index_id
+
+    def discard(self):
+        """Remove any partially written local shard, and forget the pages of shards that were not uploaded."""
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.shard_file = None
+            os.remove(self.shard_path)
+        while self.shards and self.shards[-1]["file_id"] is None:
+            self.shards.pop()
+        self.pages = {url: entry for url, entry in self.pages.items() if entry["shard"] < len(self.shards)}
+
+    def abort(self, base_url):
+        """
+        Stop a bundle whose scrape was cancelled or failed. The shards already uploaded are
+        indexed, so they stay readable through /bundlePage instead of being orphaned in Drive;
+        if the index cannot be uploaded either, they are deleted.
+        Returns the index file ID, or None if nothing was kept. Never raises.
+        """
+        try:
+            self.discard()
+            if self.shards:
+                return self.close(base_url)
+        except Exception as e:
+            print(f"Failed to index the uploaded shards of bundle {self.task_id}: {e}")
+            for shard in self.shards:
+                try:
+                    call_upstream('drive', self.drive_service.files().delete(fileId=shard["file_id"]).execute)
+                except Exception as e:
+                    print(f"Failed to delete bundle shard {shard['name']} from Google Drive: {e}")
+            self.shards = []
+            self.pages = {}
+        return None
+
+    def links(self, index_id):
+        """Drive links of the index and every shard."""
+        return [f"https://drive.google.com/file/d/{file_id}/view"
+                for file_id in [index_id] + [shard["file_id"] for shard in self.shards]]
+
+
+def scrape_pages_with_selenium(drive_service, task_id, base_url, max_pages, root_folder_id,
+                               output_mode=OUTPUT_MODE_PAGES, shard_size_mb=DEFAULT_SHARD_SIZE_MB):
     """Scrape a website and upload pages to a Google Drive sub-folder."""
     global driver
     visited_urls = set()
@@ -349,31 +2025,43 @@ def scrape_pages_with_selenium(task_id, base_url, max_pages, root_folder_id):
 
     # Extract base domain to name the subfolder
     base_domain = urlparse(base_url).netloc.replace("www.", "")
-    website_folder_id = create_google_drive_folder(base_domain, root_folder_id)
+    website_folder_id = create_google_drive_folder(drive_service, base_domain, root_folder_id)
 
     if not website_folder_id:
         tasks[task_id]["status"] = "error"
         tasks[task_id]["message"] = "Failed to create folder in Google Drive."
         return
 
+    bundle = None
+    if output_mode == OUTPUT_MODE_BUNDLE:
+        bundle = BundleWriter(drive_service, task_id, website_folder_id, shard_size_mb * 1024 * 1024)
+
     try:
         tasks[task_id]["status"] = "processing"
         while urls_to_visit:
+            if scheduler.is_cancelled(task_id):
+                break
+
             current_url = urls_to_visit.pop(0)
             if current_url in visited_urls:
                 continue
 
             print(f"Scraping: {current_url}")
-            driver.get(current_url)
+            with track_upstream('webdriver'):
+                driver.get(current_url)
             time.sleep(2)
 
-            # Save the HTML file to Google Drive
+            # Save the HTML file to Google Drive, or append it to the current bundle shard
             html_content = driver.page_source
-            file_id, file_name = save_page(current_url, html_content.encode("utf-8"), website_folder_id)
-            if file_id:
-                uploaded_files.append(f"https://drive.google.com/file/d/{file_id}/view")
+            if bundle:
+                bundle.add_page(current_url, html_content.encode("utf-8"))
+            else:
+                file_id, file_name = save_page(drive_service, current_url, html_content.encode("utf-8"), website_folder_id)
+                if file_id:
+                    uploaded_files.append(f"https://drive.google.com/file/d/{file_id}/view")
             visited_urls.add(current_url)
             pages_scraped += 1
+            SCRAPE_PAGES.inc()
 
             # Stop scraping if max_pages is reached
             if 0 < max_pages <= pages_scraped:
@@ -385,46 +2073,164 @@ def scrape_pages_with_selenium(task_id, base_url, max_pages, root_folder_id):
                 href = link.get_attribute("href")
                 if href and href.startswith(base_url) and href not in visited_urls:
                     urls_to_visit.append(href)
-
+            tasks[task_id]["pending_urls"] = len(urls_to_visit)
+
+        if scheduler.is_cancelled(task_id):
+            tasks[task_id]["status"] = "cancelled"
+            tasks[task_id]["message"] = f"Cancelled after scraping {pages_scraped} pages."
+            if bundle:
+                index_id = bundle.abort(base_url)
+                if index_id:
+                    uploaded_files = bundle.links(index_id)
+                    tasks[task_id]["message"] += (f" {len(bundle.pages)} pages in {len(bundle.shards)} uploaded "
+                                                  f"bundle shards were kept. Index file ID: {index_id}")
+            tasks[task_id]["data"] = uploaded_files
+            return
+
+        if bundle:
+            index_id = bundle.close(base_url)
+            uploaded_files = bundle.links(index_id)
+            tasks[task_id]["message"] = (f"Scraped {pages_scraped} pages into {len(bundle.shards)} "
+                                         f"bundle shards. Index file ID: {index_id}")
+        else:
+            tasks[task_id]["message"] = f"Scraped {pages_scraped} pages."
         tasks[task_id]["status"] = "completed"
-        tasks[task_id]["message"] = f"Scraped {pages_scraped} pages."
         tasks[task_id]["data"] = uploaded_files
     except Exception as e:
         tasks[task_id]["status"] = "error"
         tasks[task_id]["message"] = str(e)
+        if bundle:
+            index_id = bundle.abort(base_url)
+            if index_id:
+                tasks[task_id]["message"] += (f" {len(bundle.pages)} pages in {len(bundle.shards)} uploaded "
+                                              f"bundle shards were kept. Index file ID: {index_id}")
+                tasks[task_id]["data"] = bundle.links(index_id)
     finally:
         print(f"Task {task_id} completed.")
 
 @app.route('/scrape', methods=['POST'])
 def start_scraping():
     """Start scraping task."""
-    if not selenium_initialized or not drive_service:
-        return jsonify({"status": "error", "message": "Selenium or Google Drive not initialized"}), 500
+    if not selenium_initialized:
+        return jsonify({"status": "error", "message": "Selenium not initialized"}), 500
+
+    drive_service = user_sessions.get_service(get_caller_id(), 'drive', 'v3')
+    if drive_service is None:
+        return jsonify({"status": "error", "message": "User not authenticated. Please authenticate at /startAuth"}), 401
 
     data = request.get_json()
     url = data.get("url")
     max_pages = int(data.get("max_pages", -1))
     folder_id = data.get("folder_id")
+    output_mode = data.get("output_mode", OUTPUT_MODE_PAGES)
+    shard_size_mb = int(data.get("shard_size_mb", DEFAULT_SHARD_SIZE_MB))
+    priority = min(max(int(data.get("priority", DEFAULT_JOB_PRIORITY)), DEFAULT_JOB_PRIORITY), MAX_JOB_PRIORITY)
 
     if not url or not url.startswith("http") or not folder_id:
         return jsonify({"status": "error", "message": "Invalid input"}), 400
+    if output_mode not in (OUTPUT_MODE_PAGES, OUTPUT_MODE_BUNDLE) or shard_size_mb <= 0:
+        return jsonify({"status": "error", "message": "Invalid output_mode or shard_size_mb"}), 400
 
     task_id = str(uuid.uuid4())
-    tasks[task_id] = {"status": "queued", "message": "Scraping task queued.", "data": None}
+    tasks[task_id] = {"status": "queued", "message": "Scraping task queued.", "data": None, "user_id": get_caller_id()}
 
-    threading.Thread(target=scrape_pages_with_selenium, args=(task_id, url, max_pages, folder_id)).start()
+    try:
+        scheduler.submit('scrape', task_id, get_caller_id(), scrape_pages_with_selenium,
+                         drive_service, task_id, url, max_pages, folder_id, output_mode, shard_size_mb, priority=priority)
+    except RuntimeError as e:
+        del tasks[task_id]
+        return jsonify({"status": "error", "message": str(e)}), 503
 
     return jsonify({"status": "success", "message": "Scraping task started.", "data": {"task_id": task_id}})
 
 
+def get_caller_task(task_id):
+    """Return the task if the caller started it, else None, so other users cannot tell it exists."""
+    task = tasks.get(task_id)
+    if task is None or get_caller_id() is None or task["user_id"] != get_caller_id():
+        return None
+    return task
+
+
 @app.route('/status/<task_id>', methods=['GET'])
 def task_status(task_id):
     """Check scraping task status."""
-    task = tasks.get(task_id)
+    task = get_caller_task(task_id)
     if not task:
         return jsonify({"status": "error", "message": "Invalid task ID"}), 404
 
-    return jsonify({"status": task["status"], "message": task["message"], "data": task["data"]})
+    return jsonify({"status": task["status"], "message": task["message"], "data": task["data"],
+                    "timing": scheduler.timing(task_id)})
+
+
+@app.route('/status/<task_id>', methods=['DELETE'])
+def cancel_task(task_id):
+    """Cancel a queued or running task."""
+    task = get_caller_task(task_id)
+    if not task:
+        return jsonify({"status": "error", "message": "Invalid task ID"}), 404
+
+    state = scheduler.cancel(task_id)
+    if state is None:
+        return jsonify({"status": "error", "message": f"Task is already {task['status']}."}), 409
+
+    if state == "queued":
+        task["status"] = "cancelled"
+        task["message"] = "Task cancelled before it started."
+    else:
+        task["message"] = "Cancellation requested, the task will stop after the current page."
+
+    return jsonify({"status": "success", "message": task["message"], "data": {"task_id": task_id}})
+
+
+@app.route('/bundlePage', methods=['GET'])
+def bundle_page():
+    """
+    Fetch a single scraped page back out of a bundle by URL.
+    Only the page's gzip member is downloaded, using a ranged read of its shard.
+    """
+    index_id = request.args.get('index_id')
+    url = request.args.get('url')
+
+    if not index_id or not url:
+        return jsonify({'error': 'index_id and url are required'}), 400
+
+    try:
+        session = user_sessions.get(get_caller_id())
+        if session is None:
+            return jsonify({'error': 'User not authenticated. Please authenticate at /startAuth'}), 401
+        drive_service = user_sessions.get_service(session["user_id"], 'drive', 'v3')
+
+        # Bundle indexes never change once uploaded, so the recently used ones are kept per user
+        bundle_indexes = session["bundle_indexes"]
+        with session["lock"]:
+            index = bundle_indexes.get(index_id)
+            if index is not None:
+                bundle_indexes.move_to_end(index_id)
+        CACHE_REQUESTS.labels(cache='bundle_index', result='hit' if index is not None else 'miss').inc()
+        if index is None:
+            index = json.loads(call_upstream('drive', drive_service.files().get_media(fileId=index_id).execute))
+            with session["lock"]:
+                bundle_indexes[index_id] = index
+                while len(bundle_indexes) > MAX_CACHED_BUNDLE_INDEXES:
+                    bundle_indexes.popitem(last=False)
+
+        entry = index.get('pages', {}).get(url)
+        if not entry:
+            return jsonify({'error': 'Page not found in bundle', 'url': url}), 404
+
+        shard = index['shards'][entry['shard']]
+        start = entry['offset']
+        end = start + entry['length'] - 1
+        media_request = drive_service.files().get_media(fileId=shard['file_id'])
+        media_request.headers['Range'] = f'bytes={start}-{end}'
+        record = gzip.decompress(call_upstream('drive', media_request.execute))
+
+        return Response(parse_warc_record(record), 200, mimetype='text/html')
+    except UpstreamError:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 
 @app.route('/shareFileOnSlack', methods=['POST'])
@@ -443,25 +2249,20 @@ def share_file_on_slack():
 
     try:
         # Authenticate and build the Google Drive service
-        if os.path.exists(TOKEN_FILE):
-            with open(TOKEN_FILE, 'r') as token_file:
-                creds_json = json.load(token_file)
-                creds = Credentials.from_authorized_user_info(creds_json)
-        else:
+        drive_service = user_sessions.get_service(get_caller_id(), 'drive', 'v3')
+        if drive_service is None:
             return jsonify({'ok': False, 'error': 'User not authenticated. Please authenticate at /startAuth'}), 401
 
-        drive_service = build('drive', 'v3', credentials=creds)
-
         # Change the file permission to public
         permission = {
             'type': 'anyone',
             'role': 'reader'
         }
-        drive_service.permissions().create(
+        call_upstream('drive', drive_service.permissions().create(
             fileId=document_id,
             body=permission,
             fields='id'
-        ).execute()
+        ).execute)
 
         # Get the public URL of the document
         public_url = f"https://drive.google.com/file/d/{document_id}/view"
@@ -470,7 +2271,8 @@ def share_file_on_slack():
         message = f"{comment}\n{public_url}" if comment else public_url
 
         # Post the public URL to the specified Slack channel
-        response = client.chat_postMessage(channel=channel_id, text=message)
+        response = call_upstream('slack.chat_postMessage', client.chat_postMessage,
+                                 channel=channel_id, text=message, idempotent=False)
 
         return jsonify({
             "ok": True,
@@ -478,6 +2280,8 @@ def share_file_on_slack():
             "public_url": public_url,
             "message": "Google Drive file link shared successfully"
         })
+    except UpstreamError:
+        raise
     except SlackApiError as slack_error:
         return jsonify({"ok": False, "error": f"Slack error: {str(slack_error)}"}), 500
     except Exception as e:
@@ -499,17 +2303,12 @@ def share_file_as_attachment_on_slack():
 
     try:
         # Authenticate and build the Google Drive service
-        if os.path.exists(TOKEN_FILE):
-            with open(TOKEN_FILE, 'r') as token_file:
-                creds_json = json.load(token_file)
-                creds = Credentials.from_authorized_user_info(creds_json)
-        else:
+        drive_service = user_sessions.get_service(get_caller_id(), 'drive', 'v3')
+        if drive_service is None:
             return jsonify({'ok': False, 'error': 'User not authenticated. Please authenticate at /startAuth'}), 401
 
-        drive_service = build('drive', 'v3', credentials=creds)
-
         # Get file metadata (to fetch the file name)
-        file_metadata = drive_service.files().get(fileId=document_id, fields="name").execute()
+        file_metadata = call_upstream('drive', drive_service.files().get(fileId=document_id, fields="name").execute)
         file_name = file_metadata.get("name")
 
         # Download the file in its original format
@@ -520,22 +2319,26 @@ def share_file_as_attachment_on_slack():
             downloader = googleapiclient.http.MediaIoBaseDownload(file, request_download)
             done = False
             while not done:
-                status, done = downloader.next_chunk()
-
-        # Upload the file to Slack as an attachment
-        with open(file_path, "rb") as file:
-            response = client.files_upload(
-                channels=channel_id,
-                file=file,
-                filename=file_name,
-                initial_comment=comment
-            )
+                status, done = call_upstream('drive', downloader.next_chunk)
+
+        # Upload the file to Slack as an attachment (passed by path so a retry re-reads it from the start)
+        response = call_upstream(
+            'slack.files_upload',
+            client.files_upload,
+            channels=channel_id,
+            file=file_path,
+            filename=file_name,
+            initial_comment=comment,
+            idempotent=False
+        )
 
         return jsonify({
             "ok": True,
             "file_id": response.get("file", {}).get("id"),
             "message": "File uploaded to Slack channel successfully."
         })
+    except UpstreamError:
+        raise
     except SlackApiError as slack_error:
         return jsonify({"ok": False, "error": f"Slack error: {str(slack_error)}"}), 500
     except Exception as e:
@@ -565,7 +2368,8 @@ def generate_audio():
             }
         }
 
-        response = requests.post(f"{ELEVENLABS_URL}{VOICE_ID}", json=payload, headers=headers)
+        response = call_upstream('elevenlabs', requests.post, f"{ELEVENLABS_URL}{VOICE_ID}",
+                                 json=payload, headers=headers, timeout=120)
 
         if response.status_code != 200:
             return jsonify({"error": "Failed to generate audio", "details": response.text}), response.status_code
@@ -584,6 +2388,8 @@ def generate_audio():
             "message": "Audio file generated successfully.",
             "file_url": f"{request.host_url}/audio/{os.path.basename(audio_file_path)}"
         })
+    except UpstreamError:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -599,7 +2405,7 @@ def serve_audio(filename):
     range_header = request.headers.get('Range', None)
     if not range_header:
         # If no Range header, serve the full file
-        return send_file(file_path)
+        return send_file(os.path.abspath(file_path))
 
     # Extract byte range
     size = os.path.getsize(file_path)
@@ -644,17 +2450,12 @@ def create_contact():
 
     # Load credentials
     try:
-        if os.path.exists(TOKEN_FILE):
-            with open(TOKEN_FILE, 'r') as token_file:
-                creds_json = json.load(token_file)
-                creds = Credentials.from_authorized_user_info(creds_json)
-        else:
+        service = user_sessions.get_service(get_caller_id(), 'people', 'v1')
+        if service is None:
             return jsonify({'error': 'User not authenticated. Please authenticate at /startAuth'}), 401
     except Exception as e:
         return jsonify({'error': 'Failed to load credentials', 'details': str(e)}), 500
 
-    service = build('people', 'v1', credentials=creds)
-
     try:
         # Build the contact payload with extended fields
         contact_body = {
@@ -679,7 +2480,7 @@ def create_contact():
         contact_body['organizations'] = [org for org in contact_body['organizations'] if org.get('name') or org.get('title')]
 
         # Call Google People API to create the contact
-        created_contact = service.people().createContact(body=contact_body).execute()
+        created_contact = call_upstream('people', service.people().createContact(body=contact_body).execute, idempotent=False)
 
         return jsonify({
             "message": "Contact created successfully",
@@ -693,6 +2494,8 @@ def create_contact():
             "position": data.get('position')
         }), 201
 
+    except UpstreamError:
+        raise
     except Exception as e:
         return jsonify({"error": "Failed to create contact", "details": str(e)}), 500
 
@@ -711,30 +2514,29 @@ def get_contact():
         return jsonify({"error": "At least one of ContactId or query must be provided"}), 400
 
     # Load credentials
-    if os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, 'r') as token_file:
-            creds_json = json.load(token_file)
-            creds = Credentials.from_authorized_user_info(creds_json)
-    else:
+    service = user_sessions.get_service(get_caller_id(), 'people', 'v1')
+    if service is None:
         return jsonify({'error': 'User not authenticated. Please authenticate at /startAuth'}), 401
 
-    service = build('people', 'v1', credentials=creds)
-
     # Search by ContactId
     if contact_id:
         try:
-            person = service.people().get(resourceName=contact_id, personFields="names,emailAddresses,phoneNumbers").execute()
+            person = upstream_reads.do(('getContact', get_caller_id(), contact_id), lambda: call_upstream(
+                'people', service.people().get(resourceName=contact_id, personFields="names,emailAddresses,phoneNumbers").execute))
             return jsonify(person), 200
+        except UpstreamError:
+            raise
         except Exception as e:
             return jsonify({"error": "Contact not found", "details": str(e)}), 404
 
     # Search using the query string
     try:
-        search_results = service.people().searchContacts(
-            query=query,
-            readMask="names,emailAddresses,phoneNumbers",
-            pageSize=50  # Limit results to 50 for efficiency
-        ).execute()
+        search_results = upstream_reads.do(('searchContacts', get_caller_id(), query), lambda: call_upstream(
+            'people', service.people().searchContacts(
+                query=query,
+                readMask="names,emailAddresses,phoneNumbers",
+                pageSize=50  # Limit results to 50 for efficiency
+            ).execute))
 
         results = search_results.get('results', [])
 
@@ -743,6 +2545,8 @@ def get_contact():
 
         return jsonify({"error": "No contacts match the given criteria"}), 404
 
+    except UpstreamError:
+        raise
     except Exception as e:
         return jsonify({"error": "Failed to search contacts", "details": str(e)}), 500
 
@@ -753,25 +2557,20 @@ def update_contact():
     contact_id = data.get('ContactId')
 
     # Load credentials
-    if os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, 'r') as token_file:
-            creds_json = json.load(token_file)
-            creds = Credentials.from_authorized_user_info(creds_json)
-    else:
+    service = user_sessions.get_service(get_caller_id(), 'people', 'v1')
+    if service is None:
         return jsonify({'error': 'User not authenticated. Please authenticate at /startAuth'}), 401
 
-    service = build('people', 'v1', credentials=creds)
-
     # Validate ContactId
     if not contact_id:
         return jsonify({"error": "ContactId is required"}), 400
 
     try:
         # Fetch the existing contact to get its current etag
-        contact = service.people().get(
+        contact = call_upstream('people', service.people().get(
             resourceName=contact_id,
             personFields="names,emailAddresses,phoneNumbers"
-        ).execute()
+        ).execute)
 
         etag = contact.get('etag')
         if not etag:
@@ -822,11 +2621,11 @@ def update_contact():
                 ]
 
         # Update the contact with etag
-        updated_contact = service.people().updateContact(
+        updated_contact = call_upstream('people', service.people().updateContact(
             resourceName=contact_id,
             updatePersonFields="names,emailAddresses,phoneNumbers",
             body=updated_contact_body
-        ).execute()
+        ).execute)
 
         return jsonify({
             "message": "Contact updated successfully",
@@ -834,6 +2633,8 @@ def update_contact():
             "updatedFields": updated_contact
         }), 200
 
+    except UpstreamError:
+        raise
     except Exception as e:
         return jsonify({"error": "Failed to update contact", "details": str(e)}), 500
 
@@ -849,30 +2650,23 @@ def delete_contact():
     if not contact_id.startswith("people/"):
         return jsonify({"error": "Invalid ContactId format. It should start with 'people/'"}), 400
 
-    # Load credentials
+    # Load credentials and build the service
     try:
-        if os.path.exists(TOKEN_FILE):
-            with open(TOKEN_FILE, 'r') as token_file:
-                creds_json = json.load(token_file)
-                creds = Credentials.from_authorized_user_info(creds_json)
-        else:
+        service = user_sessions.get_service(get_caller_id(), 'people', 'v1')
+        if service is None:
             return jsonify({'error': 'User not authenticated. Please authenticate at /startAuth'}), 401
-    except Exception as e:
-        return jsonify({"error": "Failed to load credentials", "details": str(e)}), 500
-
-    # Build the service
-    try:
-        service = build('people', 'v1', credentials=creds)
     except Exception as e:
         return jsonify({"error": "Failed to initialize Google People API client", "details": str(e)}), 500
 
     # Delete the contact
     try:
-        service.people().deleteContact(resourceName=contact_id).execute()
+        call_upstream('people', service.people().deleteContact(resourceName=contact_id).execute, idempotent=False)
         return jsonify({
             "message": "Contact deleted successfully",
             "ContactId": contact_id
         }), 200
+    except UpstreamError:
+        raise
     except Exception as e:
         # Handle specific errors based on the exception content
         error_message = str(e)
@@ -884,6 +2678,9 @@ def delete_contact():
             return jsonify({"error": "Failed to delete contact", "details": error_message}), 500
 
 if __name__ == '__main__':
-    initialize_google_drive()
     initialize_selenium()
+    start_token_refresher()
+    start_search_indexer()
+    # Exit cleanly on SIGTERM so the job scheduler drains before the process stops
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(port=8080, debug=True)
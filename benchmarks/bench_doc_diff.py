@@ -0,0 +1,154 @@
+"""
+Benchmark for the minimal-diff document replacement used by /replaceDocContent.
+
+Builds large synthetic documents, applies a few small edits, and times diff_text and
+build_diff_requests. A second set of cases rewrites one contiguous section of a document,
+changing words on every line, which is the worst case for the per-block diff. The documents are split into many text runs separated by inline
+objects and contain text outside the Basic Multilingual Plane, so Docs indices (UTF-16
+code units) drift away from character offsets. Every generated batchUpdate is replayed
+against an in-memory copy of the document to check that it produces exactly the desired text.
+
+Usage: python benchmarks/bench_doc_diff.py [--sizes 100000,500000] [--edits 5] [--repeat 5]
+       [--rewrites 1000,4000,9000,20000]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault("SLACK_BOT_TOKEN", "benchmark")
+
+import app  # noqa: E402
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua café naïve 日本語 😀 𝔘𝔫𝔦𝔠𝔬𝔡𝔢 🎉🎉").split()
+
+# Stands in for an inline object, which takes up one index but contributes no text
+INLINE_OBJECT = "\ufffc"
+
+
+def make_document(size, rng):
+    """
+    Build a Docs document of random paragraphs until its text reaches size characters.
+    Returns the document and its body as a string in which every inline object is INLINE_OBJECT.
+    """
+    content = []
+    body = []
+    index = 1
+    length = 0
+    while length < size:
+        words = [rng.choice(WORDS) for _ in range(rng.randint(20, 80))]
+        cuts = sorted(rng.sample(range(1, len(words)), rng.randint(0, 3)))
+        pieces = [" ".join(words[a:b]) + " " for a, b in zip([0] + cuts, cuts + [len(words)])]
+        pieces[-1] = pieces[-1][:-1] + "\n"
+        elements = []
+        for number, piece in enumerate(pieces):
+            if number and rng.random() < 0.5:
+                elements.append({"startIndex": index, "endIndex": index + 1, "inlineObjectElement": {}})
+                body.append(INLINE_OBJECT)
+                index += 1
+            units = app.utf16_length(piece)
+            elements.append({"startIndex": index, "endIndex": index + units, "textRun": {"content": piece}})
+            body.append(piece)
+            index += units
+            length += len(piece)
+        content.append({"paragraph": {"elements": elements}})
+    return {"body": {"content": content}}, "".join(body)
+
+
+def make_edits(text, count, rng):
+    """Apply count small insert/delete/replace edits at random places."""
+    for _ in range(count):
+        position = rng.randrange(len(text) - 1)
+        kind = rng.choice(("insert", "delete", "replace"))
+        if kind == "insert":
+            text = text[:position] + "NEW TEXT " + text[position:]
+        elif kind == "delete":
+            text = text[:position] + text[position + rng.randint(1, 40):]
+        else:
+            text = text[:position] + rng.choice(WORDS).upper() + text[position + rng.randint(1, 20):]
+    if not text.endswith("\n"):
+        text += "\n"
+    return text
+
+
+def rewrite_section(text, chars, rng):
+    """Replace about a third of the words in the chars characters after a random paragraph start."""
+    starts = [0] + [i + 1 for i, char in enumerate(text[:-chars - 1]) if char == "\n"]
+    start = rng.choice(starts)
+    section = " ".join(rng.choice(WORDS).upper() if rng.random() < 0.3 else word
+                       for word in text[start:start + chars].split(" "))
+    return text[:start] + section + text[start + chars:]
+
+
+def apply_requests(body, doc_requests):
+    """Replay batchUpdate requests on a document body whose index 1 is its first UTF-16 code unit."""
+    units = body.encode("utf-16-le")
+    for doc_request in doc_requests:
+        if 'deleteContentRange' in doc_request:
+            doc_range = doc_request['deleteContentRange']['range']
+            units = units[:(doc_range['startIndex'] - 1) * 2] + units[(doc_range['endIndex'] - 1) * 2:]
+        else:
+            insert = doc_request['insertText']
+            index = (insert['location']['index'] - 1) * 2
+            units = units[:index] + insert['text'].encode("utf-16-le") + units[index:]
+    # Decoding fails if a request split a surrogate pair
+    return units.decode("utf-16-le").replace(INLINE_OBJECT, "")
+
+
+def run_case(size, edit_count, repeat, rng, rewrite_chars=None):
+    document, body = make_document(size, rng)
+    old, runs = app.extract_doc_text(document)
+    if rewrite_chars:
+        new = rewrite_section(old, rewrite_chars, rng)
+    else:
+        new = make_edits(old, edit_count, rng)
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        # The final newline is never part of the diff, as in /replaceDocContent
+        edits = app.diff_text(old[:-1], new[:-1])
+        doc_requests = app.build_diff_requests(edits, runs, old, new[:-1])
+        timings.append(time.perf_counter() - start)
+
+    if apply_requests(body, doc_requests) != new:
+        raise AssertionError(f"Diff for {size} characters does not reproduce the desired text")
+
+    timings.sort()
+    result = {"characters": len(old), "runs": len(runs)}
+    if rewrite_chars:
+        result["rewritten_characters"] = rewrite_chars
+    else:
+        result["edits"] = edit_count
+    result.update({
+        "operations": len(doc_requests),
+        "payload_bytes": len(json.dumps({"requests": doc_requests})),
+        "full_rewrite_payload_bytes": len(json.dumps({"requests": [{"insertText": {"text": new}}]})),
+        "median_ms": round(timings[len(timings) // 2] * 1000, 3),
+        "max_ms": round(timings[-1] * 1000, 3),
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="100000,250000,1000000")
+    parser.add_argument("--edits", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--rewrites", default="1000,4000,9000,20000",
+                        help="Sizes of the rewritten sections, in a 100,000 character document")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = [run_case(int(size), args.edits, args.repeat, rng) for size in args.sizes.split(",")]
+    rewrites = [run_case(100000, 0, args.repeat, rng, int(chars)) for chars in args.rewrites.split(",") if chars]
+    print(json.dumps({"benchmark": "doc_diff", "results": results, "rewrites": rewrites}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
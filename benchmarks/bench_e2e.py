@@ -0,0 +1,474 @@
+"""
+End-to-end benchmark of every route in openapi.yaml against offline stub upstreams.
+
+Starts the stubs from stub_upstreams.py, runs app.py in a child process pointed at them, and
+sends a fixed load profile: --requests requests per route at --concurrency, route by route in the
+order of LOAD_PROFILE, followed by full /scrape jobs in both output modes. Reports throughput,
+p50/p95/p99 latency, status codes and the app's peak memory after each route as JSON, so runs
+can be compared between commits.
+
+Upstream rate limits are lifted unless --keep-rate-limits is given: the stubs have no quotas,
+and the limits would otherwise dominate the numbers.
+
+/scrape needs Chrome. When Selenium cannot start, the scrape jobs are reported as skipped and
+/status is measured on unknown task IDs.
+
+Usage: python benchmarks/bench_e2e.py [--requests 200] [--concurrency 8] [--latency-ms 20]
+       [--jitter-ms 10] [--error-rate 0] [--fault docs=100,0.05] [--scrape-pages 10] [--output results.json]
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import hmac
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import stub_upstreams  # noqa: E402
+
+BENCHMARK_USER = "benchmark-user"
+CALLER_ID_SECRET = "benchmark-secret"  # The app only serves several users with signed user IDs
+APP_START_TIMEOUT = 300  # Seconds, includes indexing every stub document
+SCRAPE_TIMEOUT = 900  # Seconds per scrape job
+TERMINAL_TASK_STATES = ("completed", "error", "cancelled")
+
+
+def signed_user_id(user_id):
+    """X-User-Id header value for user_id, signed with CALLER_ID_SECRET."""
+    return user_id + "." + hmac.new(CALLER_ID_SECRET.encode("utf-8"), user_id.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def peak_rss_bytes():
+    """Peak resident memory of this process."""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def serve_app(config):
+    """Child process: run app.py against the stubs, then write ready.json to the working directory."""
+    os.chdir(config["workdir"])
+    os.environ["SLACK_BOT_TOKEN"] = "benchmark"
+    os.environ["ELEVENLABS_API_KEY"] = "benchmark"
+    os.environ["CALLER_ID_SECRET"] = CALLER_ID_SECRET
+    sys.path.insert(0, REPO_ROOT)
+
+    import app
+    from flask import jsonify
+    from google.oauth2.credentials import Credentials
+    from googleapiclient import discovery, discovery_cache
+    from slack_sdk import WebClient
+    from werkzeug.serving import make_server
+
+    google_url = config["stubs"]["google"]
+
+    def build(api, version, **kwargs):
+        # Point the bundled discovery document at the stub. client_options api_endpoint would keep
+        # media uploads on https, which the stub does not serve.
+        document = json.loads(discovery_cache.get_static_doc(api, version))
+        document["rootUrl"] = f"{google_url}/"
+        return discovery.build_from_document(document, **kwargs)
+
+    app.build = build
+    app.client = WebClient(token="benchmark", base_url=f"{config['stubs']['slack']}/api/")
+    app.ELEVENLABS_URL = f"{config['stubs']['elevenlabs']}/v1/text-to-speech/"
+    if not config["keep_rate_limits"]:
+        for bucket in app.rate_limiters.values():
+            bucket.rate = bucket.capacity = bucket.tokens = 1e9
+        # Per-user buckets are created with each session
+        app.UPSTREAM_LIMITS.update({name: (1e9, 1e9) for name in app.UPSTREAM_LIMITS})
+
+    app.user_sessions.set_credentials(BENCHMARK_USER, Credentials(
+        token="benchmark", refresh_token="benchmark-refresh-token", client_id="benchmark",
+        client_secret="benchmark", token_uri=f"{google_url}/token"))
+
+    if config["scrape"]:
+        app.initialize_selenium()
+
+    started = time.perf_counter()
+    app.index_google_docs(app.user_sessions.get(BENCHMARK_USER))
+    search_index_seconds = time.perf_counter() - started
+
+    @app.app.route('/_benchmark/memory', methods=['GET'])
+    def benchmark_memory():
+        return jsonify({"peak_rss_bytes": peak_rss_bytes()})
+
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    with open("ready.json.tmp", "w") as ready_file:
+        json.dump({
+            "port": server.port,
+            "selenium_initialized": app.selenium_initialized,
+            "selenium_error": app.selenium_error_message,
+            "search_index_seconds": round(search_index_seconds, 3),
+            "peak_rss_bytes": peak_rss_bytes(),
+        }, ready_file)
+    os.replace("ready.json.tmp", "ready.json")
+    server.serve_forever()
+
+
+def start_app(config):
+    """Start the app in a child process and wait until it is serving. Returns (process, ready info)."""
+    log_file = open(os.path.join(config["workdir"], "app.log"), "w")
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve-app", json.dumps(config)],
+                               stdout=log_file, stderr=subprocess.STDOUT)
+    ready_path = os.path.join(config["workdir"], "ready.json")
+    deadline = time.time() + APP_START_TIMEOUT
+    while not os.path.exists(ready_path):
+        if process.poll() is not None or time.time() > deadline:
+            process.kill()
+            with open(log_file.name) as log:
+                raise RuntimeError(f"App failed to start:\n{log.read()[-4000:]}")
+        time.sleep(0.1)
+    with open(ready_path) as ready_file:
+        return process, json.load(ready_file)
+
+
+def percentile(sorted_values, share):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(share * len(sorted_values)) - 1, 0)]
+
+
+def summarize(name, method, route, samples, duration, expected):
+    """samples is a list of (latency_seconds, status_code)."""
+    latencies = sorted(latency * 1000 for latency, _ in samples)
+    status_codes = {}
+    for _, status in samples:
+        status_codes[str(status)] = status_codes.get(str(status), 0) + 1
+    return {
+        "name": name,
+        "method": method,
+        "route": route,
+        "requests": len(samples),
+        "errors": sum(1 for _, status in samples if status not in expected),
+        "status_codes": status_codes,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(samples) / duration, 2) if duration else None,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies), 2) if latencies else None,
+            "p50": round(percentile(latencies, 0.50), 2) if latencies else None,
+            "p95": round(percentile(latencies, 0.95), 2) if latencies else None,
+            "p99": round(percentile(latencies, 0.99), 2) if latencies else None,
+            "max": round(latencies[-1], 2) if latencies else None,
+        },
+    }
+
+
+class LoadGenerator:
+    """Sends requests to the app from a pool of threads, one keep-alive session per thread."""
+
+    def __init__(self, base_url, concurrency):
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.local = threading.local()
+
+    def send(self, method, path, headers=None, **kwargs):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        request_headers = {"X-User-Id": signed_user_id(BENCHMARK_USER)}
+        request_headers.update(headers or {})
+        started = time.perf_counter()
+        try:
+            response = session.request(method, self.base_url + path, headers=request_headers, timeout=600, **kwargs)
+        except requests.RequestException:
+            return time.perf_counter() - started, "connection_error", None
+        return time.perf_counter() - started, response.status_code, response
+
+    def run(self, scenario, count):
+        """Send count requests of a scenario. Returns its summary and the responses kept by its collect hook."""
+        collect = scenario.get("collect")
+        collected = []
+
+        def send_one(i):
+            path, kwargs = scenario["request"](i)
+            latency, status, response = self.send(scenario["method"], path, **kwargs)
+            if collect and response is not None and response.status_code in scenario["expect"]:
+                collected.append(collect(response))
+            return latency, status
+
+        started = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as pool:
+            samples = list(pool.map(send_one, range(count)))
+        duration = time.perf_counter() - started
+        summary = summarize(scenario["name"], scenario["method"], scenario["route"], samples, duration,
+                            scenario["expect"])
+        return summary, collected
+
+    def peak_rss_mb(self):
+        _, status, response = self.send("GET", "/_benchmark/memory")
+        return round(response.json()["peak_rss_bytes"] / 1024 / 1024, 1) if status == 200 else None
+
+
+def auth_state(response):
+    return parse_qs(urlparse(response.json()["auth_url"]).query)["state"][0]
+
+
+def make_load_profile(args, site_url, auth_states):
+    """The routes of openapi.yaml in the order they are measured, each as a request builder for request i."""
+    def doc(i):
+        return stub_upstreams.document_id(i % args.docs)
+
+    def edited_document(i):
+        # A one-word edit in the middle of the document, the common case for /replaceDocContent
+        text = stub_upstreams.document_text(i % args.docs, args.doc_chars)
+        middle = len(text) // 2
+        return text[:middle] + "EDITED " + text[middle:]
+
+    search_terms = stub_upstreams.WORDS + ["Document", "title"]
+    list_queries = ["", "?name_prefix=document%201", "?mimeType=all&order_by=-modifiedTime&page_size=50",
+                    f"?folder_id={stub_upstreams.ROOT_FOLDER_ID}&page_size=20"]
+
+    return [
+        {"name": "privacy", "method": "GET", "route": "/privacy", "expect": {200},
+         "request": lambda i: ("/privacy", {})},
+        {"name": "list_channels", "method": "GET", "route": "/list_channels", "expect": {200},
+         "request": lambda i: ("/list_channels", {})},
+        {"name": "startAuth", "method": "GET", "route": "/startAuth", "expect": {200}, "collect": auth_state,
+         "request": lambda i: ("/startAuth", {"headers": {"X-User-Id": signed_user_id(f"auth-user-{i}")}})},
+        {"name": "handleAuth", "method": "GET", "route": "/handleAuth", "expect": {200},
+         "request": lambda i: (f"/handleAuth?state={auth_states[i % len(auth_states)]}&code=benchmark", {}),
+         "requires": auth_states},
+        {"name": "listFiles", "method": "GET", "route": "/listFiles", "expect": {200},
+         "request": lambda i: ("/listFiles" + list_queries[i % len(list_queries)], {})},
+        {"name": "searchDocs", "method": "GET", "route": "/searchDocs", "expect": {200},
+         "request": lambda i: (f"/searchDocs?q={search_terms[i % len(search_terms)]}", {})},
+        {"name": "readDoc", "method": "GET", "route": "/readDoc", "expect": {200},
+         "request": lambda i: (f"/readDoc?document_id={doc(i)}", {})},
+        {"name": "updateDoc", "method": "POST", "route": "/updateDoc", "expect": {200},
+         "request": lambda i: ("/updateDoc", {"json": {"document_id": doc(i), "content": f"Benchmark line {i}\n",
+                                                       "location_index": 1}})},
+        {"name": "replaceDocContent", "method": "POST", "route": "/replaceDocContent", "expect": {200},
+         "request": lambda i: ("/replaceDocContent", {"json": {"document_id": doc(i), "content": edited_document(i)}})},
+        {"name": "bundlePage", "method": "GET", "route": "/bundlePage", "expect": {200},
+         "request": lambda i: ("/bundlePage", {"params": {
+             "index_id": stub_upstreams.BUNDLE_INDEX_ID,
+             "url": stub_upstreams.site_page_url(site_url, i % args.site_pages)}})},
+        {"name": "shareFileOnSlack", "method": "POST", "route": "/shareFileOnSlack", "expect": {200},
+         "request": lambda i: ("/shareFileOnSlack", {"json": {"channel_id": "C00000000", "document_id": doc(i),
+                                                              "comment": "Benchmark share"}})},
+        {"name": "shareFileAsAttachmentOnSlack", "method": "POST", "route": "/shareFileAsAttachmentOnSlack",
+         "expect": {200},
+         "request": lambda i: ("/shareFileAsAttachmentOnSlack", {"json": {
+             "channel_id": "C00000000", "document_id": stub_upstreams.attachment_id(i % 50),
+             "comment": "Benchmark attachment"}})},
+        {"name": "generate-audio", "method": "POST", "route": "/generate-audio", "expect": {200},
+         "request": lambda i: ("/generate-audio", {"json": {"text": " ".join(search_terms[:(i % 10 + 1) * 5])}})},
+        {"name": "audio", "method": "GET", "route": "/audio/{filename}", "expect": {200},
+         "request": lambda i: ("/audio/output.mp3", {})},
+        {"name": "getContacts", "method": "POST", "route": "/getContacts", "expect": {200},
+         "request": lambda i: ("/getContacts", {"json": {"ContactId": stub_upstreams.contact_id(i)} if i % 2 else
+                                                {"query": f"Contact {i % 100}"}})},
+        {"name": "createContact", "method": "POST", "route": "/createContact", "expect": {200, 201},
+         "request": lambda i: ("/createContact", {"json": {"name": f"Benchmark Contact {i}",
+                                                           "email": f"benchmark{i}@example.com",
+                                                           "phone": "+15550000000", "company": "Benchmark",
+                                                           "position": "Tester"}})},
+        {"name": "updateContact", "method": "POST", "route": "/updateContact", "expect": {200},
+         "request": lambda i: ("/updateContact", {"json": {"ContactId": stub_upstreams.contact_id(i),
+                                                           "name": f"Updated Contact {i}",
+                                                           "email": f"updated{i}@example.com"}})},
+        {"name": "deleteContact", "method": "POST", "route": "/deleteContact", "expect": {200},
+         "request": lambda i: ("/deleteContact", {"json": {"ContactId": stub_upstreams.contact_id(i)}})},
+    ]
+
+
+def wait_for_task(load, task_id, status_samples):
+    """Poll /status until the task finishes. Returns the final status response."""
+    deadline = time.time() + SCRAPE_TIMEOUT
+    while True:
+        latency, status, response = load.send("GET", f"/status/{task_id}")
+        status_samples.append((latency, status))
+        if status != 200:
+            return {"status": "error", "message": f"/status returned {status}"}
+        task = response.json()
+        if task["status"] in TERMINAL_TASK_STATES or time.time() > deadline:
+            return task
+        time.sleep(0.25)
+
+
+def run_scrape_jobs(load, args, site_url, app_info):
+    """Full /scrape jobs in both output modes, then a cancelled one. Returns route summaries and job results."""
+    scrape_samples = []
+    status_samples = []
+    cancel_samples = []
+    jobs = []
+
+    if not app_info["selenium_initialized"]:
+        # Still measure the routes: /scrape rejects the job and /status knows no tasks
+        scrape_body = {"url": site_url, "max_pages": args.scrape_pages, "folder_id": stub_upstreams.ROOT_FOLDER_ID}
+        for i in range(args.requests):
+            latency, status, _ = load.send("POST", "/scrape", json=scrape_body)
+            scrape_samples.append((latency, status))
+            latency, status, _ = load.send("GET", f"/status/unknown-{i}")
+            status_samples.append((latency, status))
+            latency, status, _ = load.send("DELETE", f"/status/unknown-{i}")
+            cancel_samples.append((latency, status))
+        skipped = {"skipped": True, "reason": f"Selenium not initialized: {app_info['selenium_error']}"}
+        return [
+            dict(summarize("scrape", "POST", "/scrape", scrape_samples, sum(l for l, _ in scrape_samples), {500}),
+                 **skipped),
+            summarize("status", "GET", "/status/{task_id}", status_samples,
+                      sum(l for l, _ in status_samples), {404}),
+            summarize("cancelTask", "DELETE", "/status/{task_id}", cancel_samples,
+                      sum(l for l, _ in cancel_samples), {404}),
+        ], [skipped]
+
+    for output_mode in ("pages", "bundle"):
+        started = time.perf_counter()
+        latency, status, response = load.send("POST", "/scrape", json={
+            "url": site_url, "max_pages": args.scrape_pages, "folder_id": stub_upstreams.ROOT_FOLDER_ID,
+            "output_mode": output_mode, "shard_size_mb": 1})
+        scrape_samples.append((latency, status))
+        if status != 200:
+            jobs.append({"output_mode": output_mode, "status": "error", "message": f"/scrape returned {status}"})
+            continue
+        task = wait_for_task(load, response.json()["data"]["task_id"], status_samples)
+        duration = time.perf_counter() - started
+        jobs.append({
+            "output_mode": output_mode,
+            "status": task["status"],
+            "message": task.get("message"),
+            "pages": args.scrape_pages,
+            "duration_s": round(duration, 3),
+            "pages_per_second": round(args.scrape_pages / duration, 3),
+            "timing": task.get("timing"),
+        })
+
+    # A job cancelled while it runs, to measure how quickly cancellation takes effect
+    started = time.perf_counter()
+    latency, status, response = load.send("POST", "/scrape", json={
+        "url": site_url, "max_pages": -1, "folder_id": stub_upstreams.ROOT_FOLDER_ID})
+    scrape_samples.append((latency, status))
+    if status == 200:
+        task_id = response.json()["data"]["task_id"]
+        time.sleep(1)
+        latency, status, _ = load.send("DELETE", f"/status/{task_id}")
+        cancel_samples.append((latency, status))
+        cancel_started = time.perf_counter()
+        task = wait_for_task(load, task_id, status_samples)
+        jobs.append({"output_mode": "pages", "status": task["status"], "message": task.get("message"),
+                     "duration_s": round(time.perf_counter() - started, 3),
+                     "cancel_latency_s": round(time.perf_counter() - cancel_started, 3)})
+
+    total = sum(job.get("duration_s", 0) for job in jobs)
+    return [
+        summarize("scrape", "POST", "/scrape", scrape_samples, sum(l for l, _ in scrape_samples), {200}),
+        summarize("status", "GET", "/status/{task_id}", status_samples, total, {200}),
+        summarize("cancelTask", "DELETE", "/status/{task_id}", cancel_samples,
+                  sum(l for l, _ in cancel_samples), {200}),
+    ], jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="Requests per route")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=20, help="Latency of every stub upstream")
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of upstream calls answered with 429/503")
+    parser.add_argument("--fault", action="append", help="Per-upstream override: upstream=latency_ms[,error_rate]")
+    parser.add_argument("--docs", type=int, default=200, help="Google Docs in the stub Drive")
+    parser.add_argument("--doc-chars", type=int, default=5000)
+    parser.add_argument("--site-pages", type=int, default=20, help="Pages of the stub website")
+    parser.add_argument("--scrape-pages", type=int, default=10, help="Pages per /scrape job")
+    parser.add_argument("--no-scrape", action="store_true", help="Do not start Selenium")
+    parser.add_argument("--keep-rate-limits", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    parser.add_argument("--serve-app", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_app:
+        serve_app(json.loads(args.serve_app))
+        return
+
+    faults = stub_upstreams.parse_faults(args.latency_ms, args.jitter_ms, args.error_rate, args.fault, args.seed)
+    stubs = stub_upstreams.start_stubs(faults, doc_count=args.docs, doc_chars=args.doc_chars,
+                                       site_pages=args.site_pages)
+    site_url = stubs["site"].base_url
+
+    workdir = tempfile.mkdtemp(prefix="bench-e2e-")
+    with open(os.path.join(workdir, "client_secret.json"), "w") as secret_file:
+        json.dump({"web": {"client_id": "benchmark", "client_secret": "benchmark",
+                           "auth_uri": f"{stubs['google'].url}/auth", "token_uri": f"{stubs['google'].url}/token",
+                           "redirect_uris": ["http://127.0.0.1/handleAuth"]}}, secret_file)
+
+    process = None
+    try:
+        process, app_info = start_app({
+            "workdir": workdir,
+            "stubs": {name: server.url for name, server in stubs.items()},
+            "keep_rate_limits": args.keep_rate_limits,
+            "scrape": not args.no_scrape,
+        })
+        load = LoadGenerator(f"http://127.0.0.1:{app_info['port']}", args.concurrency)
+
+        routes = []
+        auth_states = []
+        for scenario in make_load_profile(args, site_url, auth_states):
+            if "requires" in scenario and not scenario["requires"]:
+                routes.append({"name": scenario["name"], "route": scenario["route"], "skipped": True})
+                continue
+            summary, collected = load.run(scenario, args.requests)
+            if scenario["name"] == "startAuth":
+                auth_states.extend(collected)
+            summary["peak_rss_mb"] = load.peak_rss_mb()
+            routes.append(summary)
+
+        if args.no_scrape:
+            app_info["selenium_error"] = "--no-scrape"
+        scrape_routes, scrape_jobs = run_scrape_jobs(load, args, site_url, app_info)
+        for summary in scrape_routes:
+            summary["peak_rss_mb"] = load.peak_rss_mb()
+        routes.extend(scrape_routes)
+
+        results = {
+            "benchmark": "e2e",
+            "config": {name: value for name, value in vars(args).items() if name not in ("output", "serve_app")},
+            "app": {
+                "search_index_seconds": app_info["search_index_seconds"],
+                "startup_peak_rss_mb": round(app_info["peak_rss_bytes"] / 1024 / 1024, 1),
+                "peak_rss_mb": load.peak_rss_mb(),
+                "selenium_initialized": app_info["selenium_initialized"],
+            },
+            "upstream_requests": {name: server.requests_served for name, server in stubs.items()},
+            "injected_errors": {name: fault.errors for name, fault in faults.items()},
+            "routes": routes,
+            "scrape_jobs": scrape_jobs,
+        }
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for server in stubs.values():
+            server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,527 @@
+"""
+Offline stand-ins for the upstreams app.py talks to, used by the benchmarks.
+
+- google: Drive v3 (listing, Changes API, media download with ranges, multipart and resumable
+  uploads, folders, permissions), Docs v1 (get, batchUpdate), People v1 (get, search, create,
+  update, delete) and the OAuth token endpoint
+- slack: the Slack Web API methods the app uses (conversations.list, chat.postMessage, files.upload)
+- elevenlabs: text-to-speech
+- site: a static website for the crawler
+
+Every upstream can be given a latency (fixed plus uniform jitter) and an error rate. Failed
+requests are answered with 429 and a Retry-After header or with 503, alternately, so both the
+retry and the backoff paths of the app are exercised. Faults come from a seeded random
+generator and documents are generated from their index, so runs are repeatable.
+
+Writes are accepted and answered like the real APIs, but documents are never modified, so every
+run of a load profile sees the same data.
+
+Usage: python benchmarks/stub_upstreams.py [--latency-ms 20] [--jitter-ms 10] [--error-rate 0]
+"""
+import argparse
+import email
+import gzip
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+GOOGLE_DOC_MIME_TYPE = 'application/vnd.google-apps.document'
+ROOT_FOLDER_ID = 'folder-root'
+BUNDLE_INDEX_ID = 'bundle-index'
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua").split()
+
+
+def document_id(index):
+    return f"doc-{index:05d}"
+
+
+def attachment_id(index):
+    return f"attachment-{index:05d}"
+
+
+def contact_id(index):
+    return f"people/c{index:05d}"
+
+
+def document_text(index, size):
+    """The text of generated document index, about size characters in paragraphs of 20 to 80 words."""
+    rng = random.Random(index)
+    paragraphs = [f"Document {index} title\n"]
+    length = len(paragraphs[0])
+    while length < size:
+        paragraph = " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 80))) + "\n"
+        paragraphs.append(paragraph)
+        length += len(paragraph)
+    return "".join(paragraphs)
+
+
+def site_page_url(base_url, index):
+    return f"{base_url}page-{index:04d}.html"
+
+
+def site_page(base_url, index, page_count):
+    """HTML of a static site page linking to the next three pages."""
+    links = "".join(f'<a href="{site_page_url(base_url, (index + step) % page_count)}">Page {(index + step) % page_count}</a>\n'
+                    for step in (1, 2, 3))
+    body = "".join(f"<p>{' '.join(WORDS)}</p>\n" for _ in range(20))
+    return f"<html><head><title>Page {index}</title></head><body>\n<h1>Page {index}</h1>\n{body}{links}</body></html>"
+
+
+class Fault:
+    """Latency and error injection for one upstream."""
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, seed=0, retry_after_s=0):
+        self.latency_ms = latency_ms
+        self.retry_after_s = retry_after_s
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.errors = 0
+
+    def inject(self):
+        """Sleep for the configured latency. Returns the error status to answer with, or None."""
+        with self.lock:
+            delay = self.latency_ms + self.rng.uniform(0, self.jitter_ms)
+            failed = self.rng.random() < self.error_rate
+            if failed:
+                self.errors += 1
+                status = 429 if self.errors % 2 else 503
+        if delay:
+            time.sleep(delay / 1000)
+        return status if failed else None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Routes requests to the server's route() and applies the upstream's fault injection."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self):
+        parsed = urlparse(self.path)
+        self.query = {name: values[0] for name, values in parse_qs(parsed.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b""
+
+        with self.server.counter_lock:
+            self.server.requests_served += 1
+        fault = self.server.faults.get(self.server.upstream_name(parsed.path))
+        status = fault.inject() if fault else None
+        if status:
+            headers = {'Retry-After': str(fault.retry_after_s)} if status == 429 else {}
+            return self.send(status, {"error": {"code": status, "message": "Injected error"}}, headers)
+        return self.server.route(self, self.command, parsed.path)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+    def json_body(self):
+        return json.loads(self.body or b"{}")
+
+    def send(self, status, payload=None, headers=None, content_type='application/json'):
+        if isinstance(payload, (dict, list)):
+            data = json.dumps(payload).encode('utf-8')
+        elif isinstance(payload, str):
+            data = payload.encode('utf-8')
+        else:
+            data = payload or b""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StubServer(ThreadingHTTPServer):
+    """A stub upstream on its own port. Subclasses implement route() and upstream_name()."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, faults, port=0):
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.faults = faults
+        self.lock = threading.Lock()
+        self.counter_lock = threading.Lock()
+        self.requests_served = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def upstream_name(self, path):
+        raise NotImplementedError
+
+    def route(self, handler, method, path):
+        raise NotImplementedError
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class GoogleStub(StubServer):
+    """Drive v3, Docs v1, People v1 and the OAuth token endpoint."""
+
+    def __init__(self, faults, port=0, doc_count=200, doc_chars=5000, attachment_count=50,
+                 contact_count=1000, site_url="http://127.0.0.1/site/", site_pages=20):
+        super().__init__(faults, port)
+        self.doc_chars = doc_chars
+        self.files = {}
+        self.media = {}
+        self.changes = []
+        self.uploads = {}
+        self.tokens_issued = 0
+        self.next_id = 0
+
+        self._add_file({'id': ROOT_FOLDER_ID, 'name': 'Benchmark', 'mimeType': 'application/vnd.google-apps.folder',
+                        'parents': []})
+        for index in range(doc_count):
+            self._add_file({'id': document_id(index), 'name': f"Document {index}",
+                            'mimeType': GOOGLE_DOC_MIME_TYPE, 'parents': [ROOT_FOLDER_ID]})
+        for index in range(attachment_count):
+            self._add_file({'id': attachment_id(index), 'name': f"attachment-{index:05d}.pdf",
+                            'mimeType': 'application/pdf', 'parents': [ROOT_FOLDER_ID]},
+                           random.Random(index).randbytes(64 * 1024))
+        self._add_bundle(site_url, site_pages)
+
+        self.contacts = {}
+        for index in range(contact_count):
+            self.contacts[contact_id(index)] = self._person(contact_id(index), f"Contact {index}",
+                                                            f"contact{index}@example.com", f"+1555{index:07d}")
+
+    def _add_file(self, metadata, content=None):
+        metadata.setdefault('modifiedTime', f"2024-01-01T00:{len(self.files) // 60 % 60:02d}:{len(self.files) % 60:02d}.000Z")
+        metadata.setdefault('trashed', False)
+        self.files[metadata['id']] = metadata
+        if content is not None:
+            self.media[metadata['id']] = content
+        self.changes.append(metadata['id'])
+        return metadata
+
+    def _add_bundle(self, site_url, page_count):
+        """A scraped-site bundle in the format written by BundleWriter: gzip'd WARC members plus a JSON index."""
+        shard = bytearray()
+        pages = {}
+        for index in range(page_count):
+            url = site_page_url(site_url, index)
+            content = site_page(site_url, index, page_count).encode('utf-8')
+            record = gzip.compress(
+                f"WARC/1.1\r\nWARC-Type: resource\r\nWARC-Target-URI: {url}\r\nContent-Type: text/html\r\n"
+                f"Content-Length: {len(content)}\r\n\r\n".encode('utf-8') + content + b"\r\n\r\n")
+            pages[url] = {"shard": 0, "offset": len(shard), "length": len(record)}
+            shard += record
+        self._add_file({'id': 'bundle-shard-0', 'name': 'bundle-00000.warc.gz', 'mimeType': 'application/gzip',
+                        'parents': [ROOT_FOLDER_ID]}, bytes(shard))
+        index = {"base_url": site_url, "format": "warc.gz",
+                 "shards": [{"name": "bundle-00000.warc.gz", "file_id": "bundle-shard-0"}], "pages": pages}
+        self._add_file({'id': BUNDLE_INDEX_ID, 'name': 'bundle-index.json', 'mimeType': 'application/json',
+                        'parents': [ROOT_FOLDER_ID]}, json.dumps(index).encode('utf-8'))
+
+    def _new_id(self, prefix):
+        with self.lock:
+            self.next_id += 1
+            return f"{prefix}-new-{self.next_id}"
+
+    @staticmethod
+    def _person(resource_name, name, email_address, phone):
+        return {
+            "resourceName": resource_name,
+            "etag": f"etag-{resource_name}",
+            "names": [{"displayName": name, "givenName": name.split()[0], "familyName": " ".join(name.split()[1:])}],
+            "emailAddresses": [{"value": email_address}],
+            "phoneNumbers": [{"value": phone}],
+        }
+
+    def upstream_name(self, path):
+        if path.startswith('/token'):
+            return 'oauth'
+        if path.startswith('/v1/documents'):
+            return 'docs'
+        if path.startswith('/v1/people'):
+            return 'people'
+        return 'drive'
+
+    def route(self, handler, method, path):
+        if path == '/token':
+            with self.lock:
+                self.tokens_issued += 1
+                token = f"benchmark-token-{self.tokens_issued}"
+            return handler.send(200, {"access_token": token, "token_type": "Bearer", "expires_in": 3600,
+                                      "refresh_token": "benchmark-refresh-token"})
+        if path.startswith('/v1/documents/'):
+            return self.handle_docs(handler, method, path[len('/v1/documents/'):])
+        if path.startswith('/v1/people'):
+            return self.handle_people(handler, method, path[len('/v1/'):])
+        if path.startswith('/upload/drive/v3/files'):
+            return self.handle_upload(handler, method)
+        if path.startswith('/drive/v3/'):
+            return self.handle_drive(handler, method, path[len('/drive/v3/'):])
+        return handler.send(404, {"error": {"code": 404, "message": f"Unknown path {path}"}})
+
+    # Drive
+
+    def handle_drive(self, handler, method, path):
+        if path == 'changes/startPageToken':
+            return handler.send(200, {"startPageToken": str(len(self.changes))})
+        if path == 'changes':
+            start = int(handler.query['pageToken'])
+            end = min(start + int(handler.query.get('pageSize', 100)), len(self.changes))
+            changes = [{"fileId": file_id, "removed": False, "file": self.files[file_id]}
+                       for file_id in self.changes[start:end]]
+            page = {"changes": changes}
+            if end < len(self.changes):
+                page["nextPageToken"] = str(end)
+            else:
+                page["newStartPageToken"] = str(end)
+            return handler.send(200, page)
+        if path == 'files' and method == 'GET':
+            files = [file for file in self.files.values() if not file['trashed']]
+            start = int(handler.query.get('pageToken') or 0)
+            end = start + int(handler.query.get('pageSize', 100))
+            page = {"files": files[start:end]}
+            if end < len(files):
+                page["nextPageToken"] = str(end)
+            return handler.send(200, page)
+        if path == 'files' and method == 'POST':
+            body = handler.json_body()
+            folder_id = self._new_id('folder')
+            with self.lock:
+                file = self._add_file({'id': folder_id, 'name': body.get('name'),
+                                       'mimeType': body.get('mimeType'), 'parents': body.get('parents', [])})
+            return handler.send(200, {"id": file['id'], "name": file['name']})
+
+        match = re.fullmatch(r'files/([^/]+)(/permissions)?', path)
+        if not match or match.group(1) not in self.files:
+            return handler.send(404, {"error": {"code": 404, "message": "File not found", "errors": [{"reason": "notFound"}]}})
+        file_id = match.group(1)
+        if match.group(2):
+            return handler.send(200, {"kind": "drive#permission", "id": "anyoneWithLink", "type": "anyone", "role": "reader"})
+        if handler.query.get('alt') != 'media':
+            return handler.send(200, self.files[file_id])
+
+        content = self.media.get(file_id, b"")
+        byte_range = re.fullmatch(r'bytes=(\d+)-(\d*)', handler.headers.get('Range', ''))
+        if byte_range:
+            start = int(byte_range.group(1))
+            end = int(byte_range.group(2)) if byte_range.group(2) else len(content) - 1
+            return handler.send(206, content[start:end + 1], {'Content-Range': f"bytes {start}-{end}/{len(content)}"},
+                                content_type='application/octet-stream')
+        return handler.send(200, content, content_type='application/octet-stream')
+
+    def handle_upload(self, handler, method):
+        upload_type = handler.query.get('uploadType')
+        if upload_type == 'multipart':
+            message = email.message_from_bytes(
+                f"Content-Type: {handler.headers['Content-Type']}\r\n\r\n".encode('utf-8') + handler.body)
+            metadata_part, media_part = message.get_payload()
+            return self._finish_upload(handler, json.loads(metadata_part.get_payload()),
+                                       media_part.get_payload(decode=True) or b"")
+
+        if upload_type == 'resumable' and method == 'POST':
+            upload_id = self._new_id('upload')
+            with self.lock:
+                self.uploads[upload_id] = {"metadata": handler.json_body(), "content": bytearray()}
+            location = f"{self.url}/upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}"
+            return handler.send(200, {}, {'Location': location})
+
+        upload = self.uploads.get(handler.query.get('upload_id'))
+        if upload is None:
+            return handler.send(404, {"error": {"code": 404, "message": "Unknown upload"}})
+        content_range = re.fullmatch(r'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)', handler.headers.get('Content-Range', ''))
+        if content_range and content_range.group(1) is not None:
+            upload["content"] += handler.body
+        total = content_range.group(3) if content_range else None
+        if total is not None and total != '*' and len(upload["content"]) >= int(total):
+            with self.lock:
+                self.uploads.pop(handler.query['upload_id'], None)
+            return self._finish_upload(handler, upload["metadata"], bytes(upload["content"]))
+        headers = {'Range': f"bytes=0-{len(upload['content']) - 1}"} if upload["content"] else {}
+        return handler.send(308, b"", headers)
+
+    def _finish_upload(self, handler, metadata, content):
+        file_id = self._new_id('file')
+        with self.lock:
+            file = self._add_file({'id': file_id, 'name': metadata.get('name'),
+                                   'mimeType': metadata.get('mimeType', 'application/octet-stream'),
+                                   'parents': metadata.get('parents', [])}, content)
+        return handler.send(200, {"id": file['id'], "name": file['name']})
+
+    # Docs
+
+    def handle_docs(self, handler, method, path):
+        doc_id, _, action = path.partition(':')
+        if doc_id not in self.files:
+            return handler.send(404, {"error": {"code": 404, "message": "Document not found"}})
+        revision_id = f"rev-{doc_id}"
+        if action == 'batchUpdate':
+            body = handler.json_body()
+            required = body.get('writeControl', {}).get('requiredRevisionId')
+            if required and required != revision_id:
+                return handler.send(400, {"error": {"code": 400, "message": "The required revision ID does not match"}})
+            return handler.send(200, {"documentId": doc_id, "replies": [{} for _ in body.get('requests', [])],
+                                      "writeControl": {"requiredRevisionId": revision_id}})
+
+        text = document_text(int(doc_id.split('-')[1]), self.doc_chars)
+        content = []
+        index = 1
+        for paragraph in text.splitlines(keepends=True):
+            end = index + len(paragraph)
+            content.append({"startIndex": index, "endIndex": end, "paragraph": {"elements": [
+                {"startIndex": index, "endIndex": end, "textRun": {"content": paragraph}}]}})
+            index = end
+        return handler.send(200, {"documentId": doc_id, "title": self.files[doc_id]['name'],
+                                  "revisionId": revision_id, "body": {"content": content}})
+
+    # People
+
+    def handle_people(self, handler, method, path):
+        if path == 'people:searchContacts':
+            query = handler.query.get('query', '').lower()
+            matches = [person for person in self.contacts.values()
+                       if query in person['names'][0]['displayName'].lower()][:int(handler.query.get('pageSize', 10))]
+            return handler.send(200, {"results": [{"person": person} for person in matches]})
+        if path == 'people:createContact':
+            body = handler.json_body()
+            resource_name = self._new_id('people/c')
+            person = dict(body, resourceName=resource_name, etag=f"etag-{resource_name}")
+            with self.lock:
+                self.contacts[resource_name] = person
+            return handler.send(200, person)
+
+        resource_name, _, action = path.partition(':')
+        person = self.contacts.get(resource_name)
+        if person is None:
+            return handler.send(404, {"error": {"code": 404, "message": "notFound", "status": "NOT_FOUND"}})
+        if action == 'updateContact':
+            body = handler.json_body()
+            if body.get('etag') != person['etag']:
+                return handler.send(400, {"error": {"code": 400, "message": "etag mismatch"}})
+            return handler.send(200, dict(person, **{key: value for key, value in body.items() if key != 'etag'}))
+        if action == 'deleteContact':
+            return handler.send(200, {})
+        return handler.send(200, person)
+
+
+class SlackStub(StubServer):
+    """The Slack Web API methods used by the app."""
+
+    def __init__(self, faults, port=0, channel_count=50):
+        super().__init__(faults, port)
+        self.channels = [{"id": f"C{index:08d}", "name": f"channel-{index}", "is_channel": True}
+                         for index in range(channel_count)]
+        self.messages = 0
+
+    def upstream_name(self, path):
+        return 'slack'
+
+    def route(self, handler, method, path):
+        slack_method = path.rsplit('/', 1)[-1]
+        with self.lock:
+            self.messages += 1
+            ts = f"{int(time.time())}.{self.messages:06d}"
+        if slack_method == 'conversations.list':
+            return handler.send(200, {"ok": True, "channels": self.channels, "response_metadata": {"next_cursor": ""}})
+        if slack_method == 'chat.postMessage':
+            return handler.send(200, {"ok": True, "channel": self.channels[0]["id"], "ts": ts})
+        if slack_method == 'files.upload':
+            return handler.send(200, {"ok": True, "file": {"id": f"F{self.messages:08d}", "size": len(handler.body)}})
+        return handler.send(200, {"ok": False, "error": "unknown_method"})
+
+
+class ElevenLabsStub(StubServer):
+    """Text-to-speech, answering with an audio payload proportional to the text length."""
+
+    def upstream_name(self, path):
+        return 'elevenlabs'
+
+    def route(self, handler, method, path):
+        if not path.startswith('/v1/text-to-speech/'):
+            return handler.send(404, {"detail": "Not found"})
+        text = handler.json_body().get('text', '')
+        size = min(max(len(text) * 100, 4096), 2 * 1024 * 1024)
+        return handler.send(200, b"ID3" + b"\x00" * (size - 3), content_type='audio/mpeg')
+
+
+class SiteStub(StubServer):
+    """A static website of page_count linked pages under /site/."""
+
+    def __init__(self, faults, port=0, page_count=20):
+        super().__init__(faults, port)
+        self.page_count = page_count
+
+    @property
+    def base_url(self):
+        return f"{self.url}/site/"
+
+    def upstream_name(self, path):
+        return 'site'
+
+    def route(self, handler, method, path):
+        match = re.fullmatch(r'/site/(?:page-(\d+)\.html)?', path)
+        index = int(match.group(1) or 0) if match else -1
+        if not 0 <= index < self.page_count:
+            return handler.send(404, "<html><body>Not found</body></html>", content_type='text/html')
+        return handler.send(200, site_page(self.base_url, index, self.page_count), content_type='text/html')
+
+
+def parse_faults(default_latency_ms, default_jitter_ms, default_error_rate, overrides, seed):
+    """
+    Build a Fault per upstream. overrides is a list of "upstream=latency_ms[,error_rate]" strings;
+    upstreams are drive, docs, people, oauth, slack, elevenlabs and site.
+    """
+    settings = {name: (default_latency_ms, default_error_rate)
+                for name in ('drive', 'docs', 'people', 'oauth', 'slack', 'elevenlabs', 'site')}
+    for override in overrides or []:
+        name, _, values = override.partition('=')
+        if name not in settings:
+            raise ValueError(f"Unknown upstream {name!r} in --fault {override!r}")
+        latency, _, error_rate = values.partition(',')
+        settings[name] = (float(latency), float(error_rate) if error_rate else settings[name][1])
+    return {name: Fault(latency, default_jitter_ms, error_rate, seed=f"{seed}:{name}")
+            for name, (latency, error_rate) in settings.items()}
+
+
+def start_stubs(faults, doc_count=200, doc_chars=5000, site_pages=20):
+    """Start every stub on a free port. Returns a dict of the running servers."""
+    site = SiteStub(faults, page_count=site_pages).start()
+    return {
+        "google": GoogleStub(faults, doc_count=doc_count, doc_chars=doc_chars,
+                             site_url=site.base_url, site_pages=site_pages).start(),
+        "slack": SlackStub(faults).start(),
+        "elevenlabs": ElevenLabsStub(faults).start(),
+        "site": site,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--fault", action="append", help="Per-upstream override: upstream=latency_ms[,error_rate]")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    faults = parse_faults(args.latency_ms, args.jitter_ms, args.error_rate, args.fault, args.seed)
+    stubs = start_stubs(faults)
+    print(json.dumps({name: server.url for name, server in stubs.items()}, indent=2))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'benchmarks'))
+os.environ.setdefault("SLACK_BOT_TOKEN", "test")
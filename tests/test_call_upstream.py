@@ -0,0 +1,200 @@
+"""
+call_upstream against a stub upstream that fails on cue: retries, Retry-After, idempotency,
+the circuit breaker, and how routes answer when an upstream gives up.
+"""
+import socket
+
+import pytest
+import requests
+
+import app
+import stub_upstreams
+
+
+class ScriptedFault(stub_upstreams.Fault):
+    """Answers requests with the given statuses in order (None passes through), then succeeds."""
+
+    def __init__(self, statuses, retry_after_s=0):
+        super().__init__(retry_after_s=retry_after_s)
+        self.statuses = list(statuses)
+
+    def inject(self):
+        with self.lock:
+            return self.statuses.pop(0) if self.statuses else None
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """A text-to-speech stub with a fresh circuit breaker and rate limiter; delays are recorded, not slept."""
+    server = stub_upstreams.ElevenLabsStub({}).start()
+    breaker = app.CircuitBreaker('elevenlabs', app.CIRCUIT_FAILURE_THRESHOLD, 60)
+    monkeypatch.setitem(app.circuit_breakers, 'elevenlabs', breaker)
+    monkeypatch.setitem(app.rate_limiters, 'elevenlabs', app.TokenBucket(1000, 1000))
+
+    delays = []
+    backoff_delay = app.backoff_delay
+
+    def record_delay(attempt, retry_after=None):
+        delays.append(backoff_delay(attempt, retry_after))
+        return 0
+    monkeypatch.setattr(app, 'backoff_delay', record_delay)
+
+    server.breaker = breaker
+    server.delays = delays
+    server.call = lambda **kwargs: app.call_upstream(
+        'elevenlabs', requests.post, f"{server.url}/v1/text-to-speech/voice", json={"text": "hi"}, timeout=5, **kwargs)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def script(server, *statuses, retry_after_s=0):
+    server.faults['elevenlabs'] = ScriptedFault(statuses, retry_after_s)
+    server.requests_served = 0
+
+
+def test_429_waits_for_retry_after(upstream):
+    script(upstream, 429, retry_after_s=7)
+
+    response = upstream.call()
+
+    assert response.status_code == 200
+    assert upstream.requests_served == 2
+    assert upstream.delays == [7.0]
+    assert upstream.breaker.failures == 0
+
+
+def test_5xx_retries_until_exhausted(upstream):
+    script(upstream, *[503] * (app.UPSTREAM_MAX_RETRIES + 2))
+
+    response = upstream.call()
+
+    assert response.status_code == 503
+    assert upstream.requests_served == app.UPSTREAM_MAX_RETRIES + 1
+    assert len(upstream.delays) == app.UPSTREAM_MAX_RETRIES
+    assert all(0 <= delay <= app.UPSTREAM_BACKOFF_MAX for delay in upstream.delays)
+
+
+def test_non_idempotent_call_is_not_retried_on_5xx(upstream):
+    script(upstream, 503)
+
+    response = upstream.call(idempotent=False)
+
+    assert response.status_code == 503
+    assert upstream.requests_served == 1
+
+
+def test_non_idempotent_call_is_retried_on_429(upstream):
+    script(upstream, 429)
+
+    response = upstream.call(idempotent=False)
+
+    assert response.status_code == 200
+    assert upstream.requests_served == 2
+
+
+ATTEMPTS_PER_CALL = app.UPSTREAM_MAX_RETRIES + 1
+
+
+def open_circuit(server):
+    """Fail calls, retries included, until the circuit opens."""
+    script(server, *[503] * (app.CIRCUIT_FAILURE_THRESHOLD * ATTEMPTS_PER_CALL))
+    for _ in range(app.CIRCUIT_FAILURE_THRESHOLD):
+        assert server.breaker.opened_at is None
+        assert server.call().status_code == 503
+    assert server.breaker.opened_at is not None
+
+
+def test_one_failing_call_does_not_open_circuit(upstream):
+    script(upstream, *[503] * ATTEMPTS_PER_CALL)
+
+    assert upstream.call().status_code == 503
+    assert upstream.breaker.failures == 1
+    assert upstream.breaker.opened_at is None
+    assert upstream.call().status_code == 200
+
+
+def test_circuit_opens_and_fails_fast(upstream):
+    open_circuit(upstream)
+
+    with pytest.raises(app.UpstreamUnavailableError):
+        upstream.call()
+    assert upstream.requests_served == app.CIRCUIT_FAILURE_THRESHOLD * ATTEMPTS_PER_CALL
+
+
+def test_half_open_trial_success_closes_circuit(upstream):
+    open_circuit(upstream)
+    upstream.breaker.opened_at -= upstream.breaker.reset_timeout
+
+    assert upstream.call().status_code == 200
+    assert upstream.breaker.opened_at is None
+    assert upstream.call().status_code == 200
+
+
+def test_half_open_trial_failure_reopens_circuit(upstream):
+    open_circuit(upstream)
+    upstream.breaker.opened_at -= upstream.breaker.reset_timeout
+    script(upstream, 503)
+
+    assert upstream.call().status_code == 503
+    with pytest.raises(app.UpstreamUnavailableError):
+        upstream.call()
+    assert upstream.requests_served == 1
+
+
+def test_half_open_trial_throttled_closes_circuit(upstream):
+    open_circuit(upstream)
+    upstream.breaker.opened_at -= upstream.breaker.reset_timeout
+    script(upstream, 429)
+
+    assert upstream.call().status_code == 200
+    assert upstream.breaker.opened_at is None
+    assert upstream.requests_served == 2
+
+
+def test_persistent_429_raises_throttled_with_retry_after(upstream):
+    script(upstream, *[429] * ATTEMPTS_PER_CALL, retry_after_s=7)
+
+    with pytest.raises(app.UpstreamThrottledError) as raised:
+        upstream.call()
+    assert raised.value.retry_after == '7'
+    assert upstream.requests_served == ATTEMPTS_PER_CALL
+    assert upstream.breaker.failures == 0
+
+
+def test_connection_errors_are_retried(upstream):
+    with socket.socket() as unused:
+        unused.bind(('127.0.0.1', 0))
+        closed_port = unused.getsockname()[1]
+
+    with pytest.raises(requests.ConnectionError):
+        app.call_upstream('elevenlabs', requests.post, f"http://127.0.0.1:{closed_port}/v1/text-to-speech/voice",
+                          json={"text": "hi"}, timeout=5)
+    assert len(upstream.delays) == app.UPSTREAM_MAX_RETRIES
+    assert upstream.breaker.failures == 1
+
+
+def raise_from_upstream(error):
+    def call_upstream(*args, **kwargs):
+        raise error
+    return call_upstream
+
+
+def test_open_circuit_is_answered_with_503(monkeypatch):
+    monkeypatch.setattr(app, 'call_upstream', raise_from_upstream(
+        app.UpstreamUnavailableError("slack is unavailable, failing fast until it recovers.", 12)))
+
+    response = app.app.test_client().get('/list_channels')
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '12'
+
+
+def test_persistent_429_is_passed_through(monkeypatch):
+    monkeypatch.setattr(app, 'call_upstream', raise_from_upstream(
+        app.UpstreamThrottledError('slack.conversations_list', '7')))
+
+    response = app.app.test_client().get('/list_channels')
+
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '7'